@@ -1,14 +1,38 @@
 """
-code fragments for brainfuck -> gnu assembly code generation
+code fragments for brainfuck -> gnu assembly (or c) code generation
 """
 
+from . import c
 from . import ia32
+from . import ia32_buffered
 from . import x86_64
+from . import x86_64_buffered
 
 KNOWN_ARCHS = {
+    '--c' : c,
     '--ia32' : ia32,
+    '--ia32-buffered' : ia32_buffered,
     '--x86-64' : x86_64,
+    '--x86-64-buffered' : x86_64_buffered,
 }
 
-def load_arch(arch_module_name):
-    return KNOWN_ARCHS[arch_module_name]
+class SizedArch:
+    """
+    the fragments of an arch module, with the program end, and the
+    program start if the module has a program_start(), replaced by
+    those for a tape of tape_size cells
+    """
+    def __init__(self, module, tape_size):
+        self.__dict__.update(vars(module))
+        self.TAPE_SIZE = tape_size
+        if hasattr(module, 'program_start'):
+            self.PROGRAM_START = module.program_start(tape_size)
+        self.PROGRAM_END = module.program_end(tape_size)
+
+def load_arch(arch_module_name, tape_size = None):
+    arch = KNOWN_ARCHS[arch_module_name]
+    if tape_size is None or tape_size == arch.TAPE_SIZE:
+        return arch
+    if tape_size <= 0:
+        raise ValueError('tape size must be positive')
+    return SizedArch(arch, tape_size)
@@ -0,0 +1,214 @@
+"""
+fragments of c code implementing the brainfuck machine, to be built
+with an optimising c compiler, e.g. gcc -O2 -x c, rather than
+assembled. this gives a baseline to compare the hand-written
+assembler fragments against.
+
+loops are written with gotos, as the fragments for each end of a loop
+are given its label, and i/o is buffered. unlike the assembler
+fragments, the c library is needed.
+"""
+
+# cells in the buffer, unless another size is asked for
+TAPE_SIZE = 30000
+
+# the runtime, then the start of main
+#
+#   p :                 the data pointer
+#   v :                 holds p[base] for the multiply idioms
+#   bf_putchar :        appends to the output buffer, writing it out
+#                       when full
+#   bf_getchar :        reads from the input buffer, refilling it when
+#                       empty. at eof *p is left unchanged, as with a
+#                       bare read
+#   bf_scan_* :         the scan idioms. stride is a constant, so gcc
+#                       can pick memchr or memrchr when it's 1. as in
+#                       the assembler, scanning off the end of the
+#                       tape is undefined
+#
+#   note :              the tape is static, so lives in .bss and needs
+#                       no zeroing
+def program_start(tape_size):
+    return r"""
+#define _GNU_SOURCE
+#include <string.h>
+#include <unistd.h>
+
+#define BF_ADD_AT(n, offset) (p[offset] += (n))
+#define BF_SUB_AT(n, offset) (p[offset] -= (n))
+#define BF_MUL_AT(factor, offset) (p[offset] += v * (factor))
+
+static unsigned char tape[%d];
+
+static unsigned char outbuf[65536];
+static size_t n_out;
+
+static unsigned char inbuf[65536];
+static size_t in_pos, in_len;
+
+static void bf_flush(void)
+{
+    unsigned char *q = outbuf;
+    while (n_out > 0) {
+        ssize_t n = write(1, q, n_out);
+        if (n <= 0)
+            break;
+        q += n;
+        n_out -= n;
+    }
+    n_out = 0;
+}
+
+static void bf_putchar(unsigned char c)
+{
+    outbuf[n_out++] = c;
+    if (n_out == sizeof(outbuf))
+        bf_flush();
+}
+
+static void bf_getchar(unsigned char *p)
+{
+    if (in_pos == in_len) {
+        ssize_t n;
+        bf_flush();
+        n = read(0, inbuf, sizeof(inbuf));
+        in_pos = 0;
+        in_len = n > 0 ? n : 0;
+        if (in_len == 0)
+            return;
+    }
+    *p = inbuf[in_pos++];
+}
+
+static unsigned char *bf_scan_right(unsigned char *p, size_t stride)
+{
+    if (stride == 1)
+        return memchr(p, 0, tape + sizeof(tape) - p);
+    while (*p)
+        p += stride;
+    return p;
+}
+
+static unsigned char *bf_scan_left(unsigned char *p, size_t stride)
+{
+    if (stride == 1)
+        return memrchr(tape, 0, p - tape + 1);
+    while (*p)
+        p -= stride;
+    return p;
+}
+
+int main(void)
+{
+    unsigned char *p = tape;
+    unsigned char v;""" % tape_size
+
+PROGRAM_START = program_start(TAPE_SIZE)
+
+WRITE_CHAR = r"""
+    bf_putchar(*p);"""
+
+READ_CHAR = r"""
+    bf_getchar(p);"""
+
+DP_RIGHT = r"""
+    ++p;"""
+
+DP_LEFT = r"""
+    --p;"""
+
+DP_INC = r"""
+    ++*p;"""
+
+DP_DEC = r"""
+    --*p;"""
+
+BEGIN_WHILE_1 = r"""
+    if (!*p) goto end_"""
+
+BEGIN_WHILE_2 = r""";
+begin_"""
+
+BEGIN_WHILE_3 = ":;"
+
+END_WHILE_1 = r"""
+    if (*p) goto begin_"""
+
+END_WHILE_2 = r""";
+end_"""
+
+END_WHILE_3 = ":;"
+
+def program_end(tape_size):
+    return r"""
+    bf_flush();
+    return 0;
+}
+"""
+
+PROGRAM_END = program_end(TAPE_SIZE)
+
+# a few extended versions for run-length encoded output
+DP_RIGHT_1 = r"""
+    p += 0x"""
+DP_RIGHT_2 = """;"""
+
+DP_LEFT_1 = r"""
+    p -= 0x"""
+DP_LEFT_2 = """;"""
+
+DP_INC_1 = r"""
+    *p += 0x"""
+DP_INC_2 = """;"""
+
+DP_DEC_1 = r"""
+    *p -= 0x"""
+DP_DEC_2 = """;"""
+
+
+# fragments for loop idioms recognised by bootstrap_bf.py
+
+# [-] : p[offset] = 0
+DP_CLEAR_1 = r"""
+    p["""
+DP_CLEAR_2 = """] = 0;"""
+
+# [->+++<] and friends : p[k] += factor * p[0] for each (k, factor)
+# term, then p[0] = 0 via DP_CLEAR_*. the offsets filled in are
+# relative to p, as for the assembler fragments
+DP_MUL_LOAD_1 = r"""
+    v = p["""
+DP_MUL_LOAD_2 = """];"""
+
+DP_MUL_ADD_1 = r"""
+    p["""
+DP_MUL_ADD_2 = """] += v;"""
+
+DP_MUL_SUB_1 = r"""
+    p["""
+DP_MUL_SUB_2 = """] -= v;"""
+
+DP_MUL_1 = r"""
+    BF_MUL_AT(0x"""
+DP_MUL_2 = """, """
+DP_MUL_3 = """);"""
+
+# [>>] : while (*p) p += stride;
+DP_SCAN_RIGHT_1 = r"""
+    p = bf_scan_right(p, 0x"""
+DP_SCAN_RIGHT_2 = """);"""
+
+DP_SCAN_LEFT_1 = r"""
+    p = bf_scan_left(p, 0x"""
+DP_SCAN_LEFT_2 = """);"""
+
+# p[offset] += n, used by the offset pass in bootstrap_bf.py
+DP_INC_AT_1 = r"""
+    BF_ADD_AT(0x"""
+DP_INC_AT_2 = """, """
+DP_INC_AT_3 = """);"""
+
+DP_DEC_AT_1 = r"""
+    BF_SUB_AT(0x"""
+DP_DEC_AT_2 = """, """
+DP_DEC_AT_3 = """);"""
@@ -3,22 +3,29 @@ fragments of gnu assembler ia32 code implementing the various
 instructions of the brainfuck machine.
 """
 
+# cells in the buffer, unless another size is asked for
+TAPE_SIZE = 30000
+
+# bytes of stack below the buffer
+STACK_SIZE = 4096
+
+# the buffer lives in .bss, which is mapped as zero pages when first
+# touched, so it needs no zeroing. %esp points to it, and the stack
+# grows down into the STACK_SIZE bytes below.
+#
+# ia32 has no %eip relative addressing, so the address of the buffer
+# is found from that of label 1, popped off the stack by the call,
+# which keeps the code position independent.
 PROGRAM_START = r"""
 .globl _start
 _start:
     start:
-    # for(int i = 0; i < 30000; ++i) buff[i] = 0
-    subl	$30000,%esp
-    movl        $0,%eax
-zero_buff_start:
-    cmpl        $30000,%eax
-    je          zero_buff_end
-    movb        $0,0(%esp,%eax,1)
-    incl        %eax
-    jmp         zero_buff_start
-zero_buff_end:
+    call	1f
+1:
+    popl	%%esp
+    addl	$bf_tape+%d-1b,%%esp
     # initialise data pointer
-    movl	$0,%eax"""
+    movl	$0,%%eax""" % STACK_SIZE
 
 WRITE_CHAR = r"""
     movl	%eax,%esi # save eax
@@ -74,12 +81,15 @@ end_"""
 
 END_WHILE_3 = ":"
 
-PROGRAM_END = r"""
-    addl	$30000,%esp
-    movl	$1,%eax
-    movl	$0,%ebx
+def program_end(tape_size):
+    return r"""
+    movl	$1,%%eax
+    movl	$0,%%ebx
     int		$0x80
-"""
+.lcomm	bf_tape,%d
+""" % (STACK_SIZE + tape_size)
+
+PROGRAM_END = program_end(TAPE_SIZE)
 
 # a few extended versions for run-length encoded output
 
@@ -99,3 +109,58 @@ DP_DEC_1 = r"""
     subb	$0x"""
 DP_DEC_2 = """, 0(%esp, %eax, 1)"""
 
+
+# loop idioms recognised by bootstrap_bf.py
+
+DP_CLEAR_1 = r"""
+    movb	$0,"""
+DP_CLEAR_2 = """(%esp, %eax, 1)"""
+
+# n.b. %ebx holds buffer[eax] while the terms are accumulated
+DP_MUL_LOAD_1 = r"""
+    movzbl	"""
+DP_MUL_LOAD_2 = """(%esp, %eax, 1),%ebx"""
+
+DP_MUL_ADD_1 = r"""
+    addb	%bl, """
+DP_MUL_ADD_2 = """(%esp, %eax, 1)"""
+
+DP_MUL_SUB_1 = r"""
+    subb	%bl, """
+DP_MUL_SUB_2 = """(%esp, %eax, 1)"""
+
+DP_MUL_1 = r"""
+    imull	$0x"""
+DP_MUL_2 = r""", %ebx, %ecx
+    addb	%cl, """
+DP_MUL_3 = """(%esp, %eax, 1)"""
+
+DP_SCAN_RIGHT_1 = r"""
+    jmp		2f
+1:
+    addl	$0x"""
+DP_SCAN_RIGHT_2 = r""", %eax
+2:
+    cmpb	$0,0(%esp, %eax, 1)
+    jne		1b"""
+
+DP_SCAN_LEFT_1 = r"""
+    jmp		2f
+1:
+    subl	$0x"""
+DP_SCAN_LEFT_2 = r""", %eax
+2:
+    cmpb	$0,0(%esp, %eax, 1)
+    jne		1b"""
+
+# offset-addressed cell updates, used by the offset pass
+
+DP_INC_AT_1 = r"""
+    addb	$0x"""
+DP_INC_AT_2 = """, """
+DP_INC_AT_3 = """(%esp, %eax, 1)"""
+
+DP_DEC_AT_1 = r"""
+    subb	$0x"""
+DP_DEC_AT_2 = """, """
+DP_DEC_AT_3 = """(%esp, %eax, 1)"""
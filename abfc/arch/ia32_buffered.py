@@ -0,0 +1,99 @@
+"""
+fragments of gnu assembler ia32 code implementing the brainfuck
+machine, with buffered i/o.
+
+identical to the ia32 fragments, except that output is collected in
+a buffer which is written when full and at exit, and input is read a
+block at a time, instead of making one syscall per byte.
+"""
+
+from .ia32 import *
+from . import ia32 as _unbuffered
+
+# %edi : number of bytes waiting in the output buffer
+# %esi : offset of the next unread byte in the input buffer
+# %ebp : number of bytes in the input buffer
+PROGRAM_START = _unbuffered.PROGRAM_START + r"""
+    movl	$0,%edi
+    movl	$0,%esi
+    movl	$0,%ebp"""
+
+# the code is kept position independent, as for the buffer. in the
+# fragments %esp is STACK_SIZE bytes past bf_tape, and the i/o buffers
+# are at fixed offsets from it, which the assembler works out as they
+# are all in .bss. the subroutines run with %esp at different depths,
+# so they find the i/o buffers from the address popped after a call,
+# as PROGRAM_START does.
+WRITE_CHAR = r"""
+    movb	0(%%esp, %%eax, 1),%%bl
+    movb	%%bl,bf_outbuf-bf_tape-%d(%%esp, %%edi, 1)
+    incl	%%edi
+    cmpl	$65536,%%edi
+    jne		1f
+    call	bf_flush_output
+1:""" % STACK_SIZE
+
+# leaves buffer[eax] unchanged if nothing can be read
+READ_CHAR = r"""
+    cmpl	%%ebp,%%esi
+    jb		1f
+    call	bf_fill_input
+    cmpl	%%ebp,%%esi
+    jae		2f
+1:
+    movb	bf_inbuf-bf_tape-%d(%%esp, %%esi, 1),%%bl
+    movb	%%bl,0(%%esp, %%eax, 1)
+    incl	%%esi
+2:""" % STACK_SIZE
+
+def program_end(tape_size):
+    return r"""
+    call	bf_flush_output""" + _unbuffered.program_end(tape_size) + r"""
+bf_flush_output:
+    pushl	%eax # save eax
+    call	3f
+3:
+    popl	%ecx
+    addl	$bf_outbuf-3b,%ecx
+1:
+    # write(stdout, ecx, edi)
+    testl	%edi,%edi
+    je		2f
+    movl	$4,%eax
+    movl	$1,%ebx
+    movl	%edi,%edx
+    int		$0x80
+    testl	%eax,%eax
+    jle		2f
+    addl	%eax,%ecx
+    subl	%eax,%edi
+    jmp		1b
+2:
+    movl	$0,%edi
+    popl	%eax # restore eax
+    ret
+bf_fill_input:
+    call	bf_flush_output
+    pushl	%eax # save eax
+    call	3f
+3:
+    popl	%ecx
+    addl	$bf_inbuf-3b,%ecx
+    # read(stdin, inbuf, 65536)
+    movl	$3,%eax
+    movl	$0,%ebx
+    movl	$65536,%edx
+    int		$0x80
+    movl	$0,%esi
+    movl	$0,%ebp
+    testl	%eax,%eax
+    jle		1f
+    movl	%eax,%ebp
+1:
+    popl	%eax # restore eax
+    ret
+.lcomm	bf_outbuf,65536
+.lcomm	bf_inbuf,65536
+"""
+
+PROGRAM_END = program_end(TAPE_SIZE)
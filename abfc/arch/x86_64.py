@@ -3,20 +3,28 @@ fragments of gnu assembler x86_64 code implementing the various
 instructions of the brainfuck machine.
 """
 
+# cells in the buffer, unless another size is asked for
+TAPE_SIZE = 30000
+
+# bytes of stack below the buffer
+STACK_SIZE = 4096
+
 # allocate buff; dp := 0;
 #
 #   convention : we use %rbx to hold dp, the offset
 #                of the data pointer into the buffer
 #
-#   convention : we make space for the buffer on the stack,
-#                with %rsp + %rbx giving the address of
-#                the %rbx-th cell in the buffer.
+#   convention : the buffer lives in .bss, with %rsp pointing
+#                to it, so %rsp + %rbx gives the address of
+#                the %rbx-th cell in the buffer. the stack
+#                grows down into the STACK_SIZE bytes below.
 #
 #   note :       we must define the global label _start
 #                as this is the entry point to our code
 #                when we build with gcc using -nostdlib
 #
-#   note :       we ensure the buffer is initialised to zero
+#   note :       .bss is mapped as zero pages when first
+#                touched, so the buffer needs no zeroing
 #
 #   note :       lastly, we initialise %rbx, the data
 #                pointer, to be zero.
@@ -24,16 +32,8 @@ PROGRAM_START = r"""
 .globl _start
 _start:
     start:
-    subq	$30000,%rsp
-    movq    $0,%rbx
-zero_buff_start:
-    cmpq    $30000,%rbx
-    je      zero_buff_end
-    movq    $0x0,0(%rsp,%rbx,1)
-    incq    %rbx
-    jmp     zero_buff_start
-zero_buff_end:
-    movq	$0,%rbx"""
+    leaq	bf_tape+%d(%%rip),%%rsp
+    movq	$0,%%rbx""" % STACK_SIZE
 
 # write(stdout, &(buffer[dp]), 1);
 #   %rax : which syscall? (0 for write)
@@ -95,15 +95,20 @@ end_"""
 
 END_WHILE_3 = ":"
 
-# free buff; exit(0)
+# exit(0)
 #   %rax : which syscall? (60 for exit)
 #   %rdi : return value
-PROGRAM_END = r"""
-    addq	$30000,%rsp
-    movq	$60,%rax
-    movq	$0,%rdi
+#
+# followed by the buffer and the stack below it
+def program_end(tape_size):
+    return r"""
+    movq	$60,%%rax
+    movq	$0,%%rdi
     syscall
-"""
+.lcomm	bf_tape,%d
+""" % (STACK_SIZE + tape_size)
+
+PROGRAM_END = program_end(TAPE_SIZE)
 
 # a few extended versions for run-length encoded output
 DP_RIGHT_1 = r"""
@@ -122,3 +127,67 @@ DP_DEC_1 = r"""
     subb	$0x"""
 DP_DEC_2 = """, 0(%rsp, %rbx, 1)"""
 
+
+# fragments for loop idioms recognised by bootstrap_bf.py
+
+# [-] : buffer[dp + offset] := 0
+DP_CLEAR_1 = r"""
+    movb	$0,"""
+DP_CLEAR_2 = """(%rsp, %rbx, 1)"""
+
+# [->+++<] and friends : buffer[dp + k] += factor * buffer[dp]
+#   for each (k, factor) term, then buffer[dp] := 0 via DP_CLEAR_*
+#   %eax : holds buffer[dp], loaded once by DP_MUL_LOAD_*
+#   %ecx : factor * buffer[dp], we only care about the low byte
+#
+#   n.b. the displacements filled in by bootstrap_bf.py are relative
+#   to dp, so the offset pass can place the whole idiom away from dp
+DP_MUL_LOAD_1 = r"""
+    movzbl	"""
+DP_MUL_LOAD_2 = """(%rsp, %rbx, 1),%eax"""
+
+DP_MUL_ADD_1 = r"""
+    addb	%al, """
+DP_MUL_ADD_2 = """(%rsp, %rbx, 1)"""
+
+DP_MUL_SUB_1 = r"""
+    subb	%al, """
+DP_MUL_SUB_2 = """(%rsp, %rbx, 1)"""
+
+DP_MUL_1 = r"""
+    imull	$0x"""
+DP_MUL_2 = r""", %eax, %ecx
+    addb	%cl, """
+DP_MUL_3 = """(%rsp, %rbx, 1)"""
+
+# [>>] : while (buffer[dp]) dp += stride;
+#   n.b. uses local labels, so the fragment may be repeated
+DP_SCAN_RIGHT_1 = r"""
+    jmp		2f
+1:
+    addq	$0x"""
+DP_SCAN_RIGHT_2 = r""", %rbx
+2:
+    cmpb	$0,0(%rsp, %rbx, 1)
+    jne		1b"""
+
+DP_SCAN_LEFT_1 = r"""
+    jmp		2f
+1:
+    subq	$0x"""
+DP_SCAN_LEFT_2 = r""", %rbx
+2:
+    cmpb	$0,0(%rsp, %rbx, 1)
+    jne		1b"""
+
+# buffer[dp + offset] += n, used by the offset pass in bootstrap_bf.py
+# to avoid moving the data pointer in straight-line code
+DP_INC_AT_1 = r"""
+    addb	$0x"""
+DP_INC_AT_2 = """, """
+DP_INC_AT_3 = """(%rsp, %rbx, 1)"""
+
+DP_DEC_AT_1 = r"""
+    subb	$0x"""
+DP_DEC_AT_2 = """, """
+DP_DEC_AT_3 = """(%rsp, %rbx, 1)"""
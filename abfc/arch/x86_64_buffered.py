@@ -0,0 +1,104 @@
+"""
+fragments of gnu assembler x86_64 code implementing the brainfuck
+machine, with buffered i/o.
+
+identical to the x86_64 fragments, except that output is collected
+in a buffer which is written when full and at exit, and input is read
+a block at a time, instead of making one syscall per byte.
+"""
+
+from .x86_64 import *
+from . import x86_64 as _unbuffered
+
+# convention : we use the following registers for the i/o buffers,
+#              none of which are touched by the other fragments
+#
+#   %r15 : address of the output buffer
+#   %r12 : number of bytes waiting in the output buffer
+#   %rbp : address of the input buffer
+#   %r13 : offset of the next unread byte in the input buffer
+#   %r14 : number of bytes in the input buffer
+#
+# note : the buffers live in .bss, and are 64k each
+PROGRAM_START = _unbuffered.PROGRAM_START + r"""
+    leaq	bf_outbuf(%rip),%r15
+    movq	$0,%r12
+    leaq	bf_inbuf(%rip),%rbp
+    movq	$0,%r13
+    movq	$0,%r14"""
+
+# buffer[dp] -> output buffer, flushing it when full
+#
+#   note : the call pushes its return address below %rsp, onto the
+#          stack below the brainfuck buffer
+WRITE_CHAR = r"""
+    movb	0(%rsp, %rbx, 1),%al
+    movb	%al,0(%r15, %r12, 1)
+    incq	%r12
+    cmpq	$65536,%r12
+    jne		1f
+    call	bf_flush_output
+1:"""
+
+# input buffer -> buffer[dp], refilling it when empty. if nothing
+# can be read, buffer[dp] is left unchanged, as with a bare read.
+READ_CHAR = r"""
+    cmpq	%r14,%r13
+    jb		1f
+    call	bf_fill_input
+    cmpq	%r14,%r13
+    jae		2f
+1:
+    movb	0(%rbp, %r13, 1),%al
+    movb	%al,0(%rsp, %rbx, 1)
+    incq	%r13
+2:"""
+
+# flush the output buffer, then exit(0)
+#
+# this is followed by the subroutines used by WRITE_CHAR and
+# READ_CHAR, which are never reached by falling through.
+#
+# bf_flush_output : write(stdout, outbuf, n) until everything has
+#                   been written, or write fails
+# bf_fill_input :   flush any output, so prompts appear before we
+#                   block, then read(stdin, inbuf, 65536)
+def program_end(tape_size):
+    return r"""
+    call	bf_flush_output""" + _unbuffered.program_end(tape_size) + r"""
+bf_flush_output:
+    movq	%r15,%rsi
+1:
+    testq	%r12,%r12
+    je		2f
+    movq	$1,%rax
+    movq	$1,%rdi
+    movq	%r12,%rdx
+    syscall
+    testq	%rax,%rax
+    jle		2f
+    addq	%rax,%rsi
+    subq	%rax,%r12
+    jmp		1b
+2:
+    movq	$0,%r12
+    ret
+bf_fill_input:
+    call	bf_flush_output
+    movq	$0,%rax
+    movq	$0,%rdi
+    movq	%rbp,%rsi
+    movq	$65536,%rdx
+    syscall
+    movq	$0,%r13
+    movq	$0,%r14
+    testq	%rax,%rax
+    jle		1f
+    movq	%rax,%r14
+1:
+    ret
+.lcomm	bf_outbuf,65536
+.lcomm	bf_inbuf,65536
+"""
+
+PROGRAM_END = program_end(TAPE_SIZE)
@@ -0,0 +1,268 @@
+"""
+compiles many files in one go, across a pool of worker processes
+
+takes a directory, or a manifest listing one file per line, relative to
+the manifest, with blank lines and lines starting with '#' skipped.
+each file is compiled as its extension says:
+
+    .b .bf .brainfuck   brainfuck -> gnu assembler, as bootstrap_bf.py
+    .py                 macro source -> brainfuck, as compile_macro.py
+
+with --run, each brainfuck program, given or compiled, is also run
+under run.py, reading <name>.in from beside the source file if there
+is one, and writing <name>.out.txt.
+
+outputs are written to the output directory, default beside each input.
+brainfuck files compiled from a macro file beside them are skipped, so
+running again over a directory doesn't compile its own output, and
+inputs which would write the same outputs are refused. a timing
+summary of each file is printed to stderr, and optionally written as
+json. the compiler and arch modules are imported before the
+pool forks, so the workers share them rather than each loading its own.
+
+usage: python abfc/batch.py --x86-64 [--jobs N] [--run] DIR|MANIFEST
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    # python 2, without the futures backport
+    ProcessPoolExecutor = None
+
+import run
+import cache
+import bootstrap_bf
+import compile_macro
+from arch import KNOWN_ARCHS, load_arch
+
+BF_EXTENSIONS = ('.b', '.bf', '.brainfuck')
+MACRO_EXTENSIONS = ('.py', )
+
+def die(s):
+    sys.stderr.write(s + '\n')
+    sys.exit(1)
+
+def _is_input(path):
+    return os.path.splitext(path)[1] in BF_EXTENSIONS + MACRO_EXTENSIONS
+
+def _is_generated(name, names):
+    # <name>.brainfuck written by an earlier run from <name>.py
+    stem, ext = os.path.splitext(name)
+    return ext == '.brainfuck' and (stem + '.py') in names
+
+def list_inputs(path):
+    """
+    returns the files to compile: those in directory path, less the
+    outputs of macro files, or those listed in manifest path
+    """
+    if os.path.isdir(path):
+        names = sorted(os.listdir(path))
+        return [os.path.join(path, name) for name in names
+            if _is_input(name) and not _is_generated(name, names)]
+    base = os.path.dirname(path)
+    inputs = []
+    with open(path, 'r') as manifest:
+        for line in manifest:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                inputs.append(os.path.join(base, line))
+    return inputs
+
+def find_clashes(inputs, out_dir):
+    """
+    returns the pairs of inputs which would write the same outputs,
+    having the same name less the extension
+    """
+    seen = {}
+    clashes = []
+    for path in inputs:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        key = os.path.normpath(os.path.join(out_dir or os.path.dirname(path),
+            stem))
+        if key in seen:
+            clashes.append((seen[key], path))
+        else:
+            seen[key] = path
+    return clashes
+
+def _write(path, s):
+    with open(path, 'w') as f:
+        f.write(s)
+
+def _compile_file(job):
+    # runs in a worker. returns a summary of the file, rather than
+    # raising, so one bad file doesn't stop the batch
+    (path, out_dir, arch_name, options) = job
+    arch = load_arch(arch_name, options['tape_size'])
+    stem, ext = os.path.splitext(os.path.basename(path))
+    def out_path(suffix):
+        return os.path.join(out_dir or os.path.dirname(path), stem + suffix)
+    c = None
+    if options['cache_dir']:
+        c = cache.Cache(options['cache_dir'], options['cache_size'])
+
+    summary = {'input' : path, 'outputs' : [], 'error' : None}
+    # the compile stages report errors with die(), which doesn't know
+    # the file name, so what they write is kept to report with it
+    stderr = sys.stderr
+    sys.stderr = StringIO()
+    t0 = time.time()
+    try:
+        with open(path, 'r') as source_file:
+            source = '\n'.join(source_file.readlines())
+        if ext in MACRO_EXTENSIONS:
+            if c is not None:
+                bf, source_map = compile_macro.compile_macro_cached(c, arch,
+                    source)
+            else:
+                source_map_out = StringIO()
+                bf = cache.capture_stdout(compile_macro.compile_macro_for_arch,
+                    arch, source, source_map_out)
+                source_map = source_map_out.getvalue()
+            outputs = [('.brainfuck', bf)]
+            if options['source_map']:
+                outputs.append(('.brainfuck.map', source_map))
+        else:
+            bf = source
+            if c is not None:
+                asm = bootstrap_bf.compile_cached(c, arch, source)
+            else:
+                asm_out = StringIO()
+                bootstrap_bf.compile_for_arch(arch, source, True, asm_out)
+                asm = asm_out.getvalue()
+            outputs = [('.s', asm)]
+        summary['compile_time'] = time.time() - t0
+        for (suffix, s) in outputs:
+            _write(out_path(suffix), s)
+            summary['outputs'].append(out_path(suffix))
+
+        if options['run']:
+            t1 = time.time()
+            input_bytes = b''
+            input_path = os.path.join(os.path.dirname(path), stem + '.in')
+            if os.path.exists(input_path):
+                with open(input_path, 'rb') as f:
+                    input_bytes = f.read()
+            output = run.run_bf(bf, input_bytes, arch.TAPE_SIZE,
+                engine = options['engine'])
+            with open(out_path('.out.txt'), 'wb') as f:
+                f.write(output)
+            summary['outputs'].append(out_path('.out.txt'))
+            summary['run_time'] = time.time() - t1
+    except SystemExit:
+        message = sys.stderr.getvalue().strip() or 'exited'
+        if message.startswith('error: '):
+            message = message[len('error: '):]
+        summary['error'] = message
+    except Exception as e:
+        summary['error'] = '%s: %s' % (type(e).__name__, e)
+    finally:
+        messages = sys.stderr.getvalue()
+        sys.stderr = stderr
+    if summary['error']:
+        stderr.write('error: %s : %s\n' % (path, summary['error']))
+    elif messages:
+        stderr.write(messages)
+    summary['time'] = time.time() - t0
+    return summary
+
+def compile_all(jobs, n_workers):
+    """
+    returns the summaries of running _compile_file on each of jobs
+    """
+    if n_workers == 1:
+        return [_compile_file(job) for job in jobs]
+    if ProcessPoolExecutor is not None:
+        with ProcessPoolExecutor(n_workers) as executor:
+            return list(executor.map(_compile_file, jobs))
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        return pool.map(_compile_file, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+def write_summary(summaries, wall_time, out):
+    width = max([len(s['input']) for s in summaries] + [len('file')])
+    out.write('%-*s %9s %9s\n' % (width, 'file', 'compile', 'run'))
+    for s in summaries:
+        if s['error']:
+            out.write('%-*s    failed\n' % (width, s['input']))
+            continue
+        line = '%-*s %9.3f' % (width, s['input'], s['compile_time'])
+        if 'run_time' in s:
+            line += ' %9.3f' % s['run_time']
+        out.write(line + '\n')
+    n_failed = len([s for s in summaries if s['error']])
+    out.write('%d files, %d failed, %.3f s total, %.3f s wall\n' % (
+        len(summaries), n_failed, sum([s['time'] for s in summaries]),
+        wall_time))
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(
+        description = 'compile many brainfuck and macro-language files')
+    arch_group = p.add_mutually_exclusive_group(required = True)
+    for arch_name in sorted(KNOWN_ARCHS):
+        arch_group.add_argument(arch_name, dest = 'arch',
+            action = 'store_const', const = arch_name)
+    p.add_argument('--jobs', '-j', type = int,
+        default = multiprocessing.cpu_count(),
+        help = 'number of worker processes (default %(default)s)')
+    p.add_argument('--output-dir', metavar = 'DIR',
+        help = 'write outputs to DIR rather than beside each input')
+    p.add_argument('--source-map', action = 'store_true',
+        help = 'also write <name>.brainfuck.map for each macro file')
+    p.add_argument('--run', action = 'store_true',
+        help = 'run each brainfuck program under run.py')
+    p.add_argument('--engine', choices = sorted(run.ENGINES),
+        default = 'python', help = 'run.py engine for --run')
+    p.add_argument('--tape-size', metavar = 'CELLS', type = int,
+        help = 'cells in the tape of the compiled programs (default 30000)')
+    p.add_argument('--summary', metavar = 'FILE',
+        help = 'write the timing summary as json to FILE')
+    cache.add_arguments(p)
+    p.add_argument('input', help = 'directory, or manifest of files')
+    args = p.parse_args()
+
+    inputs = list_inputs(args.input)
+    if not inputs:
+        die('error: no files to compile in %s' % args.input)
+    clashes = find_clashes(inputs, args.output_dir)
+    if clashes:
+        die('error: %s and %s would write the same outputs' % clashes[0])
+    if args.output_dir and not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    options = {
+        'source_map' : args.source_map,
+        'run' : args.run,
+        'engine' : args.engine,
+        'tape_size' : args.tape_size,
+        'cache_dir' : args.cache_dir,
+        'cache_size' : args.cache_size,
+    }
+    jobs = [(path, args.output_dir, args.arch, options) for path in inputs]
+
+    t0 = time.time()
+    summaries = compile_all(jobs, max(1, min(args.jobs, len(jobs))))
+    wall_time = time.time() - t0
+
+    write_summary(summaries, wall_time, sys.stderr)
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump({'arch' : args.arch, 'wall_time' : wall_time,
+                'files' : summaries}, f, indent = 2, sort_keys = True)
+            f.write('\n')
+    if [s for s in summaries if s['error']]:
+        sys.exit(1)
@@ -0,0 +1,161 @@
+"""
+intermediate representation for brainfuck programs
+
+a program is a list of ops, each op being a tuple tagged by its kind.
+offsets are relative to the data pointer, so the current cell is the
+cell at offset 0:
+
+    ('add', n, offset)  add n to the cell at offset, 0 < n < 256
+    ('move', n)         move the data pointer n cells to the right
+                        (or -n cells to the left if n < 0), n != 0
+    ('loop', body)      run the list of ops body while the current
+                        cell is nonzero
+    ('read', )          read a byte from input into the current cell
+    ('write', )         write the current cell to output
+
+the loop idiom pass (see optimize_loops) also introduces:
+
+    ('clear', offset)   set the cell at offset to zero
+    ('mul', offset, terms)
+                        for each (k, factor) pair in terms, add factor
+                        times the cell at offset to the cell at
+                        offset + k, 0 < factor < 256. then set the
+                        cell at offset to zero
+    ('scan', stride)    move the data pointer stride cells at a time
+                        until the current cell is zero
+
+ops produced by parse and optimize_loops only ever use offset 0. the
+offset pass (see offset_ops) then removes moves from straight-line
+code by addressing cells relative to a virtual data pointer.
+"""
+
+def _append_folded(ops, kind, n):
+    # merge with the previous op if it is of the same kind. if the
+    # ops cancel out, drop them, which may in turn let the op
+    # before that merge with whatever comes next.
+    if ops and ops[-1][0] == kind:
+        n += ops.pop()[1]
+    if kind == 'add' and n % 256 != 0:
+        ops.append(('add', n % 256, 0))
+    elif kind == 'move' and n != 0:
+        ops.append(('move', n))
+
+def parse(s):
+    """
+    parse brainfuck source s into a list of ops. runs of +, -, <, >
+    are folded into single add and move ops. characters that are
+    not brainfuck opcodes are ignored.
+    raises ValueError if the brackets in s are unbalanced.
+    """
+    program = []
+    ops = program
+    enclosing = []
+    for c in s:
+        if c == '+':
+            _append_folded(ops, 'add', 1)
+        elif c == '-':
+            _append_folded(ops, 'add', -1)
+        elif c == '>':
+            _append_folded(ops, 'move', 1)
+        elif c == '<':
+            _append_folded(ops, 'move', -1)
+        elif c == '.':
+            ops.append(('write', ))
+        elif c == ',':
+            ops.append(('read', ))
+        elif c == '[':
+            body = []
+            ops.append(('loop', body))
+            enclosing.append(ops)
+            ops = body
+        elif c == ']':
+            if not enclosing:
+                raise ValueError('encountered "]" without matching "["')
+            ops = enclosing.pop()
+    if enclosing:
+        raise ValueError('encountered "[" without matching "]"')
+    return program
+
+def _match_mul_loop(body):
+    # a balanced loop of adds and moves that steps the current cell
+    # by -1 (or +1) each time around runs exactly cell (or -cell)
+    # times, so it is equivalent to a multiply-accumulate into each
+    # of the other cells it touches. returns the (offset, factor)
+    # terms, or None if the loop doesn't have that shape.
+    deltas = {}
+    offset = 0
+    for op in body:
+        if op[0] == 'add':
+            deltas[offset + op[2]] = deltas.get(offset + op[2], 0) + op[1]
+        elif op[0] == 'move':
+            offset += op[1]
+        else:
+            return None
+    if offset != 0:
+        return None
+    step = deltas.pop(0, 0) % 256
+    if step == 255:
+        sign = 1
+    elif step == 1:
+        sign = -1
+    else:
+        return None
+    terms = []
+    for k in sorted(deltas):
+        factor = (sign * deltas[k]) % 256
+        if factor != 0:
+            terms.append((k, factor))
+    return terms
+
+def _optimize_loop(body):
+    body = optimize_loops(body)
+    if len(body) == 1 and body[0][0] == 'move':
+        return ('scan', body[0][1])
+    terms = _match_mul_loop(body)
+    if terms is None:
+        return ('loop', body)
+    elif not terms:
+        return ('clear', 0)
+    else:
+        return ('mul', 0, terms)
+
+def optimize_loops(ops):
+    """
+    replace loops matching common idioms with straight-line ops:
+
+        [-] [+]             --> clear
+        [->+<] [->>+++<<]   --> mul
+        [>] [<<]            --> scan
+    """
+    return [_optimize_loop(op[1]) if op[0] == 'loop' else op for op in ops]
+
+def offset_ops(ops):
+    """
+    track a virtual data pointer through straight-line code, turning
+    moves into offsets on the ops that follow them. the real data
+    pointer is only updated before loops, scans and i/o, and at the
+    end of each loop body.
+    """
+    ops_prime = []
+    offset = 0
+    for op in ops:
+        kind = op[0]
+        if kind == 'move':
+            offset += op[1]
+        elif kind == 'add':
+            ops_prime.append(('add', op[1], op[2] + offset))
+        elif kind == 'clear':
+            ops_prime.append(('clear', op[1] + offset))
+        elif kind == 'mul':
+            ops_prime.append(('mul', op[1] + offset, op[2]))
+        else:
+            if offset != 0:
+                ops_prime.append(('move', offset))
+                offset = 0
+            if kind == 'loop':
+                ops_prime.append(('loop', offset_ops(op[1])))
+            else:
+                ops_prime.append(op)
+    if offset != 0:
+        ops_prime.append(('move', offset))
+    return ops_prime
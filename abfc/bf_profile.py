@@ -0,0 +1,160 @@
+"""
+execution profiles of brainfuck programs, as gathered by run.py
+
+run.py counts the times each list of ops runs: the program itself,
+then each loop body, in the order the loops start. brainfuck has no
+jumps other than loops, so every opcode in a list runs once each time
+the list does, which gives the number of times each opcode of the
+source ran. a '[' belongs to the list around its loop, and the
+matching ']' to the loop's body, as it runs once per iteration. loops
+that bf_ir replaces with clear, mul or scan ops count as running their
+body once each time they are reached.
+
+the counts can be folded through a source map, as written by
+compile_macro.py --source-map, into the stacks of macro and built-in
+names that generated the code. the folded stacks can be fed to
+flamegraph.pl and the like.
+"""
+
+import bf_ir
+
+OPCODES = '+-<>[].,'
+
+def _loop_bodies(ops, bodies):
+    # the bodies of the loops in ops, in the order they start
+    for op in ops:
+        if op[0] == 'loop':
+            bodies.append(op[1])
+            _loop_bodies(op[1], bodies)
+    return bodies
+
+def _is_kept(body):
+    # False if bf_ir replaces the loop with a straight-line op
+    return bf_ir.optimize_loops([('loop', body)])[0][0] == 'loop'
+
+class Profile:
+    """
+    counts of the steps executed by a run of brainfuck source s, given
+    the list counts filled in by run.compile_bf:
+
+        opcode_counts   the times each opcode ran, by opcode number
+                        (opcodes are numbered ignoring other chars)
+        loop_counts     the iterations of each loop run as a loop,
+                        by the opcode number of its '['
+    """
+    def __init__(self, s, list_counts):
+        opcodes = [c for c in s if c in OPCODES]
+        kept = [_is_kept(body) for body in _loop_bodies(bf_ir.parse(s), [])]
+        assert len(list_counts) == 1 + len([k for k in kept if k])
+        self.loop_counts = {}
+        # the list each opcode belongs to, and for each list, the list
+        # around it and the opcode number of its '['
+        self.opcode_lists = [0] * len(opcodes)
+        self.list_parents = [None]
+        self.list_starts = [None]
+        # lists open around the current opcode, innermost last, and
+        # for each loop open, its list, or None if it was replaced
+        lists = [0]
+        loops = []
+        n_loops = 0
+        for (i, c) in enumerate(opcodes):
+            if c == '[':
+                self.opcode_lists[i] = lists[-1]
+                if kept[n_loops]:
+                    self.list_parents.append(lists[-1])
+                    self.list_starts.append(i)
+                    lists.append(len(self.list_parents) - 1)
+                    loops.append(lists[-1])
+                else:
+                    loops.append(None)
+                n_loops += 1
+            elif c == ']':
+                self.opcode_lists[i] = lists[-1]
+                if loops.pop() is not None:
+                    k = lists.pop()
+                    self.loop_counts[self.list_starts[k]] = list_counts[k]
+            else:
+                self.opcode_lists[i] = lists[-1]
+        self.opcode_counts = [list_counts[k] for k in self.opcode_lists]
+
+    def fold(self, source_map):
+        """
+        returns a dict mapping the stacks of names in source_map, a
+        list of (first opcode, end opcode, names) triples as returned
+        by read_source_map, to the steps executed in their code.
+        raises ValueError if source_map doesn't cover the program.
+        """
+        if not source_map or source_map[-1][1] != len(self.opcode_counts):
+            raise ValueError('source map does not match the program')
+        stacks = {}
+        for (start, end, names) in source_map:
+            steps = sum(self.opcode_counts[start:end])
+            stacks[names] = stacks.get(names, 0) + steps
+        return stacks
+
+    def fold_loops(self):
+        """
+        returns a dict mapping stacks of the loops around each opcode,
+        named by the opcode numbers of their '[', to the steps executed
+        directly inside them
+        """
+        names = ['program'] + ['loop@%d' % i for i in self.list_starts[1:]]
+        steps = [0] * len(names)
+        for (k, count) in zip(self.opcode_lists, self.opcode_counts):
+            steps[k] += count
+        stacks = {}
+        for k in range(len(names)):
+            stack = []
+            j = k
+            while j is not None:
+                stack.append(names[j])
+                j = self.list_parents[j]
+            stacks[tuple(reversed(stack))] = steps[k]
+        return stacks
+
+def read_source_map(f):
+    """
+    reads a source map written by codegen.write_source_map, returning
+    a list of (first opcode, end opcode, names) triples
+    """
+    source_map = []
+    for line in f:
+        start, end, names = line.split()
+        source_map.append((int(start), int(end), tuple(names.split(';'))))
+    return source_map
+
+def write_folded(stacks, out):
+    """
+    writes stacks, a dict mapping tuples of names to steps, as folded
+    stacks, one 'outer;inner steps' line per stack
+    """
+    for names in sorted(stacks):
+        if stacks[names]:
+            out.write('%s %d\n' % (';'.join(names), stacks[names]))
+
+def write_report(stacks, out, limit = 20):
+    """
+    writes a summary of stacks to out: the stacks accounting for the
+    most steps, counting the steps of the stacks inside them, then the
+    names with the most steps executed directly in their own code
+    """
+    total = sum(stacks.values())
+    inclusive = {}
+    exclusive = {}
+    for (names, steps) in stacks.items():
+        for i in range(1, len(names) + 1):
+            inclusive[names[:i]] = inclusive.get(names[:i], 0) + steps
+        exclusive[names[-1]] = exclusive.get(names[-1], 0) + steps
+
+    def percent(steps):
+        return 100.0 * steps / max(total, 1)
+
+    out.write('steps executed: %d\n' % total)
+    out.write('\nsteps by stack, including the stacks inside it:\n')
+    ranked = sorted(inclusive.items(), key = lambda x: (-x[1], x[0]))
+    for (names, steps) in ranked[:limit]:
+        out.write('%7.2f%%  %s\n' % (percent(steps), ';'.join(names)))
+    out.write('\nsteps by name, in its own code:\n')
+    ranked = sorted(exclusive.items(), key = lambda x: (-x[1], x[0]))
+    for (name, steps) in ranked[:limit]:
+        out.write('%7.2f%%  %s\n' % (percent(steps), name))
@@ -5,8 +5,16 @@ output of compiler is printed to stdout
 """
 
 import sys
+import argparse
 import itertools
 from arch import KNOWN_ARCHS, load_arch
+import bf_ir
+import cache
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 def die(s):
     sys.stderr.write(s + '\n')
@@ -15,57 +23,143 @@ def die(s):
 def emit(s):
     sys.stdout.write(s)
 
-def compile_for_arch(arch, s):
+def compile_for_arch(arch, s, offsets = True, out = None):
+    """
+    writes the code for brainfuck source s to out, by default stdout
+    """
+    if out is None:
+        out = sys.stdout
+    try:
+        program = bf_ir.optimize_loops(bf_ir.parse(s))
+    except ValueError as e:
+        die('error: %s' % e)
+    if offsets:
+        program = bf_ir.offset_ops(program)
+
     unique_labels = itertools.count()
-    label_stack = []
 
-    def begin_while():
-        i = next(unique_labels)
-        label_stack.append(i)
+    def begin_while(i):
         return (arch.BEGIN_WHILE_1 + ('%04x' % i) +
             arch.BEGIN_WHILE_2 + ('%04x' % i) +
             arch.BEGIN_WHILE_3)
 
-    def end_while():
-        if not label_stack:
-            die('error: encountered "]" without matching "["')
-        i = label_stack.pop()
+    def end_while(i):
         return (arch.END_WHILE_1 + ('%04x' % i) +
             arch.END_WHILE_2 + ('%04x' % i) +
             arch.END_WHILE_3)
 
+    # runs are emitted through the run-length encoded fragments,
+    # falling back to the single step fragments for runs of one.
+    def gen_add(n, offset):
+        if offset != 0:
+            if n < 128:
+                return (arch.DP_INC_AT_1 + ('%02x' % n) +
+                    arch.DP_INC_AT_2 + str(offset) + arch.DP_INC_AT_3)
+            else:
+                return (arch.DP_DEC_AT_1 + ('%02x' % (256 - n)) +
+                    arch.DP_DEC_AT_2 + str(offset) + arch.DP_DEC_AT_3)
+        elif n == 1:
+            return arch.DP_INC
+        elif n == 255:
+            return arch.DP_DEC
+        elif n < 128:
+            return arch.DP_INC_1 + ('%02x' % n) + arch.DP_INC_2
+        else:
+            return arch.DP_DEC_1 + ('%02x' % (256 - n)) + arch.DP_DEC_2
+
+    def gen_move(n):
+        if n == 1:
+            return arch.DP_RIGHT
+        elif n == -1:
+            return arch.DP_LEFT
+        elif n > 0:
+            return arch.DP_RIGHT_1 + ('%02x' % n) + arch.DP_RIGHT_2
+        else:
+            return arch.DP_LEFT_1 + ('%02x' % (-n)) + arch.DP_LEFT_2
+
+    def gen_loop(body):
+        i = next(unique_labels)
+        return begin_while(i) + gen_ops(body) + end_while(i)
+
+    def gen_clear(offset):
+        return arch.DP_CLEAR_1 + str(offset) + arch.DP_CLEAR_2
+
+    def gen_mul(base, terms):
+        code = arch.DP_MUL_LOAD_1 + str(base) + arch.DP_MUL_LOAD_2
+        for (k, factor) in terms:
+            offset = base + k
+            if factor == 1:
+                code += arch.DP_MUL_ADD_1 + str(offset) + arch.DP_MUL_ADD_2
+            elif factor == 255:
+                code += arch.DP_MUL_SUB_1 + str(offset) + arch.DP_MUL_SUB_2
+            else:
+                code += (arch.DP_MUL_1 + ('%02x' % factor) +
+                    arch.DP_MUL_2 + str(offset) + arch.DP_MUL_3)
+        return code + gen_clear(base)
+
+    def gen_scan(stride):
+        if stride > 0:
+            return arch.DP_SCAN_RIGHT_1 + ('%02x' % stride) + arch.DP_SCAN_RIGHT_2
+        else:
+            return arch.DP_SCAN_LEFT_1 + ('%02x' % (-stride)) + arch.DP_SCAN_LEFT_2
+
     code_generator = {
-        '<' : lambda : arch.DP_LEFT,
-        '>' : lambda : arch.DP_RIGHT,
-        '+' : lambda : arch.DP_INC,
-        '-' : lambda : arch.DP_DEC,
-        '[' : begin_while,
-        ']' : end_while,
-        '.' : lambda : arch.WRITE_CHAR,
-        ',' : lambda : arch.READ_CHAR,
+        'add' : gen_add,
+        'move' : gen_move,
+        'loop' : gen_loop,
+        'clear' : gen_clear,
+        'mul' : gen_mul,
+        'scan' : gen_scan,
+        'write' : lambda : arch.WRITE_CHAR,
+        'read' : lambda : arch.READ_CHAR,
     }
-    emit(arch.PROGRAM_START)
-    for c in s:
-        if c in code_generator:
-            emit(code_generator[c]())
-        else:
-            pass # ignore unrecognised characters
-    emit(arch.PROGRAM_END)
 
-def print_usage_and_die():
-    usage_hint = 'usage: [%s] input.bf' % ('|'.join(sorted(KNOWN_ARCHS)))
-    die(usage_hint)
+    def gen_ops(ops):
+        return ''.join([code_generator[op[0]](*op[1:]) for op in ops])
+
+    out.write(arch.PROGRAM_START)
+    out.write(gen_ops(program))
+    out.write(arch.PROGRAM_END)
+
+def compile_cached(c, arch, s, offsets = True):
+    """
+    returns the output of compile_for_arch, taking it from cache c if
+    it's there
+    """
+    stage = 'bootstrap_bf' + ('' if offsets else ' --no-offsets')
+    key = cache.make_key(stage, s, arch)
+    output = c.get(key)
+    if output is not None:
+        return output.decode('utf-8')
+    out = StringIO()
+    compile_for_arch(arch, s, offsets, out)
+    output = out.getvalue()
+    c.put(key, output.encode('utf-8'))
+    return output
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print_usage_and_die()
-    if sys.argv[1] not in KNOWN_ARCHS:
-        print_usage_and_die()
-
-    arch = load_arch(sys.argv[1])
-    
-    with open(sys.argv[2], 'r') as source_file:
-        s = '\n'.join(source_file.readlines())
+    p = argparse.ArgumentParser(
+        description = 'compile brainfuck source to gnu assembler')
+    arch_group = p.add_mutually_exclusive_group(required = True)
+    for arch_name in sorted(KNOWN_ARCHS):
+        arch_group.add_argument(arch_name, dest = 'arch',
+            action = 'store_const', const = arch_name)
+    p.add_argument('--no-offsets', dest = 'offsets', action = 'store_false',
+        help = 'update the data pointer after every move, rather than '
+            'addressing cells by offset within straight-line code')
+    p.add_argument('--tape-size', metavar = 'CELLS', type = int,
+        help = 'cells in the tape of the compiled program (default 30000)')
+    cache.add_arguments(p)
+    p.add_argument('input', help = 'brainfuck source file')
+    args = p.parse_args()
 
-    compile_for_arch(arch, s)
+    arch = load_arch(args.arch, args.tape_size)
+
+    with open(args.input, 'r') as source_file:
+        s = '\n'.join(source_file.readlines())
 
+    if args.cache_dir:
+        c = cache.Cache(args.cache_dir, args.cache_size)
+        emit(compile_cached(c, arch, s, offsets = args.offsets))
+    else:
+        compile_for_arch(arch, s, offsets = args.offsets)
@@ -0,0 +1,162 @@
+"""
+a content-addressed cache for the output of the slow python stages
+
+entries are files in the cache directory, named by the sha256 of
+everything the output depends on: the stage, its input, the selected
+arch module's source, and the compiler version, which is the hash of
+all the python source in abfc/ and abfc/arch/, as arch modules import
+each other's fragments. entries are written
+atomically, so concurrent builds can share a cache directory. once
+the entries add up to more than the size limit, the least recently
+used are evicted, going by their mtimes, which are updated on each
+hit.
+"""
+
+import os
+import sys
+import hashlib
+import tempfile
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+ABFC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_compiler_version = None
+
+def _python_source(path):
+    # modules may have been loaded from bytecode
+    if path.endswith('.pyc') or path.endswith('.pyo'):
+        path = path[:-1]
+    with open(path, 'rb') as f:
+        return f.read()
+
+def compiler_version():
+    """
+    sha256 of the python source in abfc/ and abfc/arch/
+    """
+    global _compiler_version
+    if _compiler_version is None:
+        h = hashlib.sha256()
+        for sub_dir in ('', 'arch'):
+            directory = os.path.join(ABFC_DIR, sub_dir)
+            for name in sorted(os.listdir(directory)):
+                if name.endswith('.py'):
+                    path = os.path.join(sub_dir, name)
+                    h.update(path.encode('utf-8') + b'\0')
+                    h.update(_python_source(os.path.join(ABFC_DIR, path)))
+        _compiler_version = h.hexdigest()
+    return _compiler_version
+
+def make_key(stage, input_source, arch):
+    """
+    returns the cache key for running stage on input_source, a string,
+    for the arch module arch, and its tape size
+    """
+    h = hashlib.sha256()
+    parts = [
+        stage.encode('utf-8'),
+        input_source.encode('utf-8'),
+        _python_source(arch.__file__),
+        ('%d' % arch.TAPE_SIZE).encode('ascii'),
+        compiler_version().encode('ascii'),
+    ]
+    for part in parts:
+        # length prefixed, so the parts can't run into each other
+        h.update(('%d:' % len(part)).encode('ascii'))
+        h.update(part)
+    return h.hexdigest()
+
+class Cache:
+    def __init__(self, directory, max_bytes = DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # another build may have just made it
+                if not os.path.isdir(directory):
+                    raise
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """
+        returns the bytes stored under key, or None
+        """
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+            os.utime(self.path(key), None)
+        except (IOError, OSError):
+            # missing, or evicted by another build
+            return None
+        return data
+
+    def put(self, key, data):
+        """
+        stores data, bytes, under key, then evicts entries until the
+        cache fits in max_bytes
+        """
+        fd, tmp_path = tempfile.mkstemp(dir = self.directory, prefix = '.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, self.path(key))
+        finally:
+            # only left behind if the write or rename failed
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        self.evict(keep = key)
+
+    def evict(self, keep = None):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            try:
+                st = os.stat(self.path(name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+            total += st.st_size
+        entries.sort()
+        for (mtime, name, size) in entries:
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            try:
+                os.unlink(self.path(name))
+            except OSError:
+                pass
+            total -= size
+
+def capture_stdout(f, *args):
+    """
+    calls f(*args), returning what it wrote to stdout
+    """
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        f(*args)
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+def add_arguments(p):
+    """
+    adds the cache options to argparse parser p
+    """
+    p.add_argument('--cache-dir', metavar = 'DIR',
+        help = 'reuse output cached in DIR, if the inputs are unchanged')
+    p.add_argument('--cache-size', metavar = 'BYTES', type = int,
+        default = DEFAULT_MAX_BYTES,
+        help = 'evict cached output beyond this size (default %(default)s)')
@@ -53,13 +53,176 @@ def match_string_constant(x):
     assert is_string_constant(x)
     return x[1]
 
+class LineWrappingSink:
+    """
+    writes code to out, a file-like object, as it is emitted, broken
+    into lines of line_width characters. call close() once all the
+    code has been written to finish the last line.
+    """
+    def __init__(self, out, line_width = 70):
+        self.out = out
+        self.line_width = line_width
+        self.line = []
+        self.line_length = 0
+
+    def write(self, code):
+        i = 0
+        while len(code) - i >= self.line_width - self.line_length:
+            j = i + self.line_width - self.line_length
+            self.line.append(code[i:j])
+            self.out.write(''.join(self.line) + '\n')
+            self.line = []
+            self.line_length = 0
+            i = j
+        if i < len(code):
+            self.line.append(code[i:])
+            self.line_length += len(code) - i
+
+    def close(self):
+        if self.line:
+            self.out.write(''.join(self.line) + '\n')
+            self.line = []
+            self.line_length = 0
+
+def _known_value(known_values, default_zero, i):
+    if i in known_values:
+        return known_values[i]
+    elif default_zero:
+        return 0
+    else:
+        return None
+
+def write_source_map(source_map, n_opcodes, out):
+    """
+    write source_map, as recorded by a Machine emitting n_opcodes
+    opcodes, to out. each line gives a range of opcode numbers, from
+    the first up to but not including the last, and the stack of
+    names that generated it, outermost first, separated by ';'
+    """
+    ends = [start for (start, names) in source_map[1:]] + [n_opcodes]
+    for ((start, names), end) in zip(source_map, ends):
+        if start < end:
+            out.write('%d %d %s\n' % (start, end, ';'.join(names)))
+
+class NullSink:
+    """
+    discards code, for passes that only gather information
+    """
+    def write(self, code):
+        pass
+
+    def close(self):
+        pass
+
 class Machine:
-    def __init__(self, n_cells):
+    """
+    emits brainfuck to sink, keeping track of the data pointer and of
+    which cells hold known values.
+
+    loop_writes, if given, is the loop_writes list recorded by an
+    earlier pass over the same program: for each loop begun by the
+    program itself (rather than inside a built-in), the set of cells
+    its body wrote to, or None if that is not known. values of cells
+    outside that set are still known inside the loop. a loop whose body
+    shifts the stack frame is taken to write every cell.
+
+    if record_sources is set, source_map lists the stack of user macro
+    and built-in names (see push_source) in effect from each opcode
+    on, as (opcode number, names) pairs.
+    """
+    def __init__(self, n_cells, sink, loop_writes = None,
+            record_sources = False):
         self.n_cells = n_cells
         self.bf_ptr = 0
         self.stack_ptr = 0
-        self.code = []
+        self.sink = sink
+        # number of opcodes written to sink
+        self.n_emitted = 0
+        self.source_stack = []
+        self.source_map = [] if record_sources else None
         self.loop_stack = []
+        # run of moves and increments not yet emitted, as a list of
+        # ('>', n) and ('+', n) pairs, with adjacent pairs of the same
+        # kind merged and pairs that cancel out dropped
+        self.pending = []
+        # depth of loops not being emitted, as they could never run
+        self.dead_loops = 0
+        # known values of cells, by absolute cell index. a value of None
+        # marks a cell as unknown. cells not listed are zero if
+        # default_zero is set, and unknown otherwise.
+        self.known_values = {}
+        self.default_zero = True
+        # (known_values, default_zero, loop number, cells, n_shifts,
+        # stack_ptr) on entry to each emitted loop
+        self.known_values_stack = []
+        # number of times the stack frame has been shifted, outside
+        # dead loops
+        self.n_shifts = 0
+        # cells written by the bodies of the emitted loops currently
+        # open, or None where any cell may have been written
+        self.written = []
+        self.previous_loop_writes = loop_writes
+        self.loop_writes = []
+
+    def pend(self, kind, n):
+        if self.dead_loops:
+            return
+        if self.pending and self.pending[-1][0] == kind:
+            n += self.pending.pop()[1]
+        if kind == '+':
+            # cells are bytes
+            n %= 256
+        if n != 0:
+            self.pending.append((kind, n))
+
+    def write(self, code):
+        self.n_emitted += len(code)
+        self.sink.write(code)
+
+    def flush(self):
+        for (kind, n) in self.pending:
+            if kind == '>' and n > 0:
+                self.write('>' * n)
+            elif kind == '>':
+                self.write('<' * (-n))
+            elif n <= 128:
+                self.write('+' * n)
+            else:
+                self.write('-' * (256 - n))
+        self.pending = []
+
+    def emit(self, code):
+        if self.dead_loops:
+            return
+        self.flush()
+        self.write(code)
+
+    def push_source(self, name):
+        """
+        note that the code emitted from now until the matching
+        pop_source is generated by the macro or built-in name
+        """
+        self.source_stack.append(name)
+        self.note_source()
+
+    def pop_source(self):
+        self.source_stack.pop()
+        self.note_source()
+
+    def note_source(self):
+        # n.b. runs of moves and increments still pending are credited
+        # to whichever stack is in effect when they are flushed
+        if self.source_map is None:
+            return
+        entry = (self.n_emitted, tuple(self.source_stack))
+        if self.source_map and self.source_map[-1][0] == self.n_emitted:
+            self.source_map.pop()
+        if not self.source_map or self.source_map[-1][1] != entry[1]:
+            self.source_map.append(entry)
+
+    def close(self):
+        self.flush()
+        self.sink.close()
 
     def validate(self):
         assert 0 <= self.bf_ptr < self.n_cells
@@ -68,15 +231,50 @@ class Machine:
         return self.bf_ptr - self.stack_ptr
 
     def do_move(self, offset):
-        if offset == 0:
-            pass
-        elif offset > 0:
-            self.code.append('>' * offset)
-        else:
-            self.code.append('<' * (-offset))
+        self.pend('>', offset)
         self.bf_ptr += offset
         self.validate()
 
+    def known_value(self, i = None):
+        """
+        returns the value of cell i, by default the current cell, or
+        None if it is not known
+        """
+        if i is None:
+            i = self.bf_ptr
+        return _known_value(self.known_values, self.default_zero, i)
+
+    def known_value_at(self, stack_address):
+        return self.known_value(self.stack_ptr + match_stack_address(stack_address))
+
+    def set_known_value(self, value):
+        if not self.dead_loops:
+            self.known_values[self.bf_ptr] = value
+
+    def forget_known_values(self):
+        self.known_values = {}
+        self.default_zero = False
+
+    def shift_stack(self, n):
+        """
+        move the stack frame n cells to the right. the cells still
+        needed must already have been moved into the new frame.
+        """
+        self.stack_ptr += n
+        if self.dead_loops:
+            # the frame doesn't really move, so keep the known values
+            # at the same stack addresses
+            self.known_values = dict([(i + n, value)
+                for (i, value) in self.known_values.items()])
+            return
+        # the loops currently open now shift the frame, which
+        # do_end_loop checks for
+        self.n_shifts += 1
+
+    def note_write(self):
+        if self.written and self.written[-1] is not None:
+            self.written[-1].add(self.bf_ptr)
+
     def do_move_to_stack_address(self, stack_address):
         stack_offset = match_stack_address(stack_address)
         dst_ptr = self.stack_ptr + stack_offset
@@ -89,70 +287,204 @@ class Machine:
     def do_right(self):
         self.do_move(1)
 
+    def do_add(self, n):
+        value = self.known_value()
+        if value is not None:
+            self.set_known_value((value + n) % 256)
+        if not self.dead_loops:
+            self.note_write()
+        self.pend('+', n)
+        self.validate()
+
     def do_inc(self, n = 1):
         assert n >= 0
-        if n > 0:
-            self.code.append('+' * n)
-        self.validate()
+        self.do_add(n)
 
     def do_dec(self, n = 1):
         assert n >= 0
-        if n > 0:
-            self.code.append('-' * n)
-        self.validate()
-
-    def do_begin_loop(self):
-        self.code.append('[')
+        self.do_add(-n)
+
+    def do_begin_loop(self, writes = None):
+        """
+        begin a loop on the current cell. writes lists the stack
+        addresses of the cells the body may write to; if None, the loop
+        is part of the program, and the cells written are taken from
+        the earlier pass, if there was one.
+        """
+        loop_number = None
+        if writes is None:
+            loop_number = len(self.loop_writes)
+            self.loop_writes.append(None)
+            if self.previous_loop_writes is not None:
+                cells = self.previous_loop_writes[loop_number]
+            else:
+                cells = None
+        else:
+            cells = [self.stack_ptr + match_stack_address(x) for x in writes]
+        if self.dead_loops or self.known_value() == 0:
+            self.dead_loops += 1
+        else:
+            self.emit('[')
+            self.known_values_stack.append((self.known_values,
+                self.default_zero, loop_number, cells, self.n_shifts,
+                self.stack_ptr))
+            self.written.append(set())
+            # the body may run any number of times, so the cells it
+            # writes to are unknown inside it
+            if cells is None:
+                self.forget_known_values()
+            else:
+                self.known_values = dict(self.known_values)
+                for i in cells:
+                    self.known_values[i] = None
         self.loop_stack.append(self.get_bf_ptr_relative_to_stack())
         self.validate()
 
     def do_end_loop(self):
-        self.code.append(']')
+        if self.dead_loops:
+            self.dead_loops -= 1
+        else:
+            self.emit(']')
+            (before, before_default_zero, loop_number, cells, n_shifts,
+                stack_ptr) = self.known_values_stack.pop()
+            written = self.written.pop()
+            if n_shifts != self.n_shifts or stack_ptr != self.stack_ptr:
+                # the body shifts the stack frame, so it may or may not
+                # have run with the frame anywhere, and any cell may
+                # have been written. a dead loop in the body may also
+                # have shifted it, leaving the known values since then
+                # at other indices than those before the loop
+                written = None
+            if cells is not None:
+                assert written is not None and written <= set(cells)
+            if loop_number is not None:
+                self.loop_writes[loop_number] = written
+            if self.written and self.written[-1] is not None:
+                if written is None:
+                    self.written[-1] = None
+                else:
+                    self.written[-1] |= written
+            # the loop may not have run at all, so values the body may
+            # have changed are only still known if they are the same as
+            # before the loop
+            after, after_default_zero = self.known_values, self.default_zero
+            if written is None:
+                self.forget_known_values()
+            else:
+                self.known_values = dict(before)
+                self.default_zero = before_default_zero
+                for i in written:
+                    value = _known_value(before, before_default_zero, i)
+                    if value != _known_value(after, after_default_zero, i):
+                        value = None
+                    self.known_values[i] = value
+            self.known_values[self.bf_ptr] = 0
         # invariant : bf_ptr must have the same value
         # after [x] for all executation paths
         assert self.loop_stack.pop() == self.get_bf_ptr_relative_to_stack()
         self.validate()
 
     def do_read(self):
-        self.code.append(',')
+        self.emit(',')
+        self.set_known_value(None)
+        if not self.dead_loops:
+            self.note_write()
         self.validate()
 
     def do_write(self):
-        self.code.append('.')
+        self.emit('.')
         self.validate()
 
     def do_unvalidated_bf(self, bf_opcodes):
         known_opcodes = '<>+-[].,'
         for c in bf_opcodes:
             assert c in known_opcodes
-        self.code.append(bf_opcodes)
-
-    def dump_code(self):
-        print(''.join(self.code))
+        self.emit(bf_opcodes)
+        if not self.dead_loops:
+            self.forget_known_values()
+            if self.written:
+                self.written[-1] = None
 
 _BUILT_IN_MACROS = {}
 
 def _invoke_macro(machine, stack_man, macro_name, *args):
     if macro_name not in _BUILT_IN_MACROS:
         raise KeyError('unknown builtin macro : %s' % repr(macro_name))
+    machine.push_source(macro_name)
     _BUILT_IN_MACROS[macro_name](machine, stack_man, *args)
+    machine.pop_source()
 
 def BUILT_IN_MACRO(f):
     _BUILT_IN_MACROS[f.__name__] = f
     return f
 
+# how each built-in uses the cells passed as its arguments, for liveness
+# analysis: 'r' if the cell is read, 'w' if it is overwritten without
+# being read, 'rw' if it is read and then changed. constant arguments
+# are None. built-ins not listed are assumed to read every argument.
+ARGUMENT_EFFECTS = {
+    'clear' : ('w', ),
+    'destructive_add' : ('rw', 'rw'),
+    'destructive_sub' : ('rw', 'rw'),
+    'move' : ('rw', 'w'),
+    'copy' : ('r', 'w'),
+    'stack_add' : ('r', 'rw'),
+    'constant_add' : (None, 'rw'),
+    'stack_sub' : ('r', 'rw'),
+    'constant_sub' : (None, 'rw'),
+    'as_logical' : ('r', 'w'),
+    'logical_not' : ('r', 'w'),
+    'logical_or' : ('r', 'r', 'w'),
+    'logical_and' : ('r', 'r', 'w'),
+    # at eof the cell is left unchanged
+    'get_char' : ('rw', ),
+    'put_char' : ('r', ),
+    'put_string_constant' : (None, ),
+    'begin_loop' : ('r', ),
+    'end_loop' : ('r', ),
+    # values are moved, but preserved
+    'grow_stack' : (None, ),
+    'shrink_stack' : (None, ),
+}
+
+# built-ins whose results are known constants set their destinations
+# directly, using at most this many + or - opcodes per cell
+MAX_FOLDED_INCS = 16
+
+def _inc_length(n):
+    n %= 256
+    return min(n, 256 - n)
+
+def _is_foldable(value):
+    return value is not None and _inc_length(value) <= MAX_FOLDED_INCS
+
+def _set_constant(machine, dst, value):
+    # set dst to value, adjusting its known value if that is shorter
+    # than clearing it first
+    machine.do_move_to_stack_address(dst)
+    current = machine.known_value()
+    if current is None or _inc_length(value - current) > 3 + _inc_length(value):
+        machine.do_begin_loop(writes = [dst])
+        machine.do_dec()
+        machine.do_end_loop()
+        current = 0
+    machine.do_add(value - current)
+
 @BUILT_IN_MACRO
 def clear(machine, stack_man, dst):
-    machine.do_move_to_stack_address(dst)
-    machine.do_begin_loop()
-    machine.do_dec()
-    machine.do_end_loop()
+    _set_constant(machine, dst, 0)
 
 @BUILT_IN_MACRO
 def destructive_add(machine, stack_man, src, dst):
     assert_no_aliasing(src, dst)
+    value = machine.known_value_at(src)
+    if _is_foldable(value):
+        machine.do_move_to_stack_address(dst)
+        machine.do_add(value)
+        _set_constant(machine, src, 0)
+        return
     machine.do_move_to_stack_address(src)
-    machine.do_begin_loop()
+    machine.do_begin_loop(writes = [src, dst])
     machine.do_dec()
     machine.do_move_to_stack_address(dst)
     machine.do_inc()
@@ -162,8 +494,14 @@ def destructive_add(machine, stack_man, src, dst):
 @BUILT_IN_MACRO
 def destructive_sub(machine, stack_man, src, dst):
     assert_no_aliasing(src, dst)
+    value = machine.known_value_at(src)
+    if _is_foldable(value):
+        machine.do_move_to_stack_address(dst)
+        machine.do_add(-value)
+        _set_constant(machine, src, 0)
+        return
     machine.do_move_to_stack_address(src)
-    machine.do_begin_loop()
+    machine.do_begin_loop(writes = [src, dst])
     machine.do_dec()
     machine.do_move_to_stack_address(dst)
     machine.do_dec()
@@ -179,10 +517,15 @@ def move(machine, stack_man, src, dst):
 def copy(machine, stack_man, src, dst):
     _tmp0 = stack_man.allocate_local()
     assert_no_aliasing(src, dst, _tmp0)
+    value = machine.known_value_at(src)
+    if _is_foldable(value):
+        _set_constant(machine, dst, value)
+        stack_man.free_local(_tmp0)
+        return
     _invoke_macro(machine, stack_man, 'clear', dst)
     _invoke_macro(machine, stack_man, 'clear', _tmp0)
     machine.do_move_to_stack_address(src)
-    machine.do_begin_loop()
+    machine.do_begin_loop(writes = [src, dst, _tmp0])
     machine.do_dec()
     machine.do_move_to_stack_address(dst)
     machine.do_inc()
@@ -223,10 +566,15 @@ def constant_sub(machine, stack_man, src, dst):
 def as_logical(machine, stack_man, src, dst):
     _tmp0 = stack_man.allocate_local()
     assert_no_aliasing(src, dst, _tmp0)
+    value = machine.known_value_at(src)
+    if value is not None:
+        _set_constant(machine, dst, int(value != 0))
+        stack_man.free_local(_tmp0)
+        return
     _invoke_macro(machine, stack_man, 'copy', src, _tmp0)
     _invoke_macro(machine, stack_man, 'clear', dst)
     machine.do_move_to_stack_address(_tmp0)
-    machine.do_begin_loop()
+    machine.do_begin_loop(writes = [dst, _tmp0])
     machine.do_move_to_stack_address(dst)
     machine.do_inc()
     _invoke_macro(machine, stack_man, 'clear', _tmp0)
@@ -237,12 +585,17 @@ def as_logical(machine, stack_man, src, dst):
 def logical_not(machine, stack_man, src, dst):
     _tmp0 = stack_man.allocate_local()
     assert_no_aliasing(src, dst, _tmp0)
+    value = machine.known_value_at(src)
+    if value is not None:
+        _set_constant(machine, dst, int(value == 0))
+        stack_man.free_local(_tmp0)
+        return
     _invoke_macro(machine, stack_man, 'copy', src, _tmp0)
     _invoke_macro(machine, stack_man, 'clear', dst)
     machine.do_move_to_stack_address(dst)
     machine.do_inc()
     machine.do_move_to_stack_address(_tmp0)
-    machine.do_begin_loop()
+    machine.do_begin_loop(writes = [dst, _tmp0])
     machine.do_move_to_stack_address(dst)
     machine.do_dec()
     _invoke_macro(machine, stack_man, 'clear', _tmp0)
@@ -289,17 +642,15 @@ def put_char(machine, stack_man, dst):
 def put_string_constant(machine, stack_man, string_constant):
     s = match_string_constant(string_constant)
     _tmp0 = stack_man.allocate_local()
-    _invoke_macro(machine, stack_man, 'clear', _tmp0)
+    # start from whatever _tmp0 is known to hold
+    machine.do_move_to_stack_address(_tmp0)
+    current_char = machine.known_value()
+    if current_char is None:
+        _invoke_macro(machine, stack_man, 'clear', _tmp0)
+        current_char = 0
     chars = list(map(ord, s))
-    current_char = 0
     for c in chars:
-        delta_char = c - current_char
-        if delta_char > 0:
-            machine.do_inc(delta_char)
-        elif delta_char == 0:
-            pass
-        elif delta_char < 0:
-            machine.do_dec(-delta_char)
+        machine.do_add(c - current_char)
         machine.do_write()
         current_char = c
     stack_man.free_local(_tmp0)
@@ -314,13 +665,21 @@ def end_loop(machine, stack_man, src):
     machine.do_move_to_stack_address(src)
     machine.do_end_loop()
 
+def _shifted_cells(stack_man, live):
+    # the offsets of the cells to carry over into a new stack frame:
+    # every allocated cell, unless given the list of cells whose
+    # values are still needed
+    if live is None:
+        return stack_man.allocated_cells()
+    return sorted([match_stack_address(x) for x in live])
+
 @BUILT_IN_MACRO
-def grow_stack(machine, stack_man, size):
+def grow_stack(machine, stack_man, size, live = None):
     n = match_constant(size)
     assert n >= 0
     if n == 0:
         return
-    offsets = stack_man.allocated_cells()
+    offsets = _shifted_cells(stack_man, live)
     for x in reversed(offsets):
         src = make_stack_address(x)
         dst = make_stack_address(x + n)
@@ -328,17 +687,17 @@ def grow_stack(machine, stack_man, size):
     for x in range(n):
         src = make_stack_address(x)
         _invoke_macro(machine, stack_man, 'clear', src)
-    machine.stack_ptr += n
+    machine.shift_stack(n)
 
 @BUILT_IN_MACRO
-def shrink_stack(machine, stack_man, size):
+def shrink_stack(machine, stack_man, size, live = None):
     n = match_constant(size)
     assert n >= 0
     if n == 0:
         return
-    offsets = stack_man.allocated_cells()
+    offsets = _shifted_cells(stack_man, live)
     for x in offsets:
         src = make_stack_address(x)
         dst = make_stack_address(x - n)
         _invoke_macro(machine, stack_man, 'move', src, dst)
-    machine.stack_ptr -= n
+    machine.shift_stack(-n)
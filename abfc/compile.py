@@ -1,7 +1,17 @@
+import sys
+import heapq
+import bisect
 import pattern_match as pm
 from sugar import *
 import expr as expression
 import codegen
+import liveness
+import layout
+
+_CONSTANT_MATCHERS = [
+    (tag, pm.match(L((tag, pm.Star('x')))))
+    for tag in ('int_constant', 'char_constant', 'string_constant', 'stack_address')
+]
 
 class BaseEnv:
     def __init__(self):
@@ -9,22 +19,10 @@ class BaseEnv:
         self.bound_vars = {}
 
     def get(self, key):
-        int_matcher = pm.match(L(('int_constant', pm.Star('x'))))
-        m = int_matcher.attempt_match(key)
-        if m is not None:
-            return ('int_constant', m['x'])
-        char_matcher = pm.match(L(('char_constant', pm.Star('x'))))
-        m = char_matcher.attempt_match(key)
-        if m is not None:
-            return ('char_constant', m['x'])
-        string_matcher = pm.match(L(('string_constant', pm.Star('x'))))
-        m = string_matcher.attempt_match(key)
-        if m is not None:
-            return ('string_constant', m['x'])
-        stack_address_matcher = pm.match(L(('stack_address', pm.Star('x'))))
-        m = stack_address_matcher.attempt_match(key)
-        if m is not None:
-            return ('stack_address', m['x'])
+        for (tag, matcher) in _CONSTANT_MATCHERS:
+            m = matcher.attempt_match(key)
+            if m is not None:
+                return (tag, m['x'])
         raise KeyError(key)
 
 class Env:
@@ -65,45 +63,96 @@ def pretty_print_env(env):
         env = env.parent
         i += 1
 
+_stack_address_matcher = pm.match(('stack_address', pm.Star('i')))
+
 class StackMan:
+    """
+    allocates stack cells, handing out the lowest free offset unless
+    asked for a particular one.
+
+    cells below the high water mark that have been freed are kept on a
+    min-heap, and the allocated offsets are also kept in a sorted list,
+    so neither allocating nor listing the cells needs a linear probe.
+    cells allocated by offset are left on the heap, and skipped when
+    they reach the top.
+    """
+
     def __init__(self):
         self._allocated_cells = set()
+        self._sorted_cells = []
+        self._free_cells = []
+        self._high_water_mark = 0
 
     def next_free_cell(self):
-        i = 0
-        while i in self._allocated_cells:
-            i += 1
-        return i
-
-    def allocate_local(self):
-        i = self.next_free_cell()
+        while self._free_cells and self._free_cells[0] in self._allocated_cells:
+            heapq.heappop(self._free_cells)
+        if self._free_cells:
+            return self._free_cells[0]
+        else:
+            return self._high_water_mark
+
+    def allocate_local(self, i = None):
+        if i is None:
+            i = self.next_free_cell()
+        assert i >= 0 and i not in self._allocated_cells
+        if i >= self._high_water_mark:
+            for j in range(self._high_water_mark, i):
+                heapq.heappush(self._free_cells, j)
+            self._high_water_mark = i + 1
         self._allocated_cells.add(i)
+        bisect.insort(self._sorted_cells, i)
         return ('stack_address', i)
 
     def free_local(self, local):
-        m = pm.match(('stack_address', pm.Star('i'))).attempt_match(local)
+        m = _stack_address_matcher.attempt_match(local)
         assert m is not None
-        self._allocated_cells.remove(m['i'])
+        i = m['i']
+        self._allocated_cells.remove(i)
+        del self._sorted_cells[bisect.bisect_left(self._sorted_cells, i)]
+        heapq.heappush(self._free_cells, i)
 
     def allocated_cells(self):
-        return list(sorted(list(self._allocated_cells)))
+        return list(self._sorted_cells)
 
 
 class CompilerState:
-    def __init__(self, current_env, stack_man, machine):
+    def __init__(self, current_env, stack_man, machine, lowered = None,
+            layout = None, shifted = None):
         self.current_env = current_env
         self.stack_man = stack_man
         self.machine = machine
-
-def compile_phase_2(built_in_macros, macro):
-
-    n_cells = 30000
-
-    state = CompilerState(
-        current_env = BaseEnv(),
-        stack_man = StackMan(),
-        machine = codegen.Machine(n_cells),
-    )
+        # built-in calls are numbered in the order they are made.
+        # lowered maps call numbers to the built-in to call instead
+        self.lowered = lowered or {}
+        # shifted maps the numbers of calls shifting the stack to the
+        # storage ids of the allocations live across them
+        self.shifted = shifted or {}
+        self.n_calls = 0
+        # with no machine, calls are recorded for liveness analysis
+        # instead, as (name, storage ids) pairs. storage ids are given
+        # out per allocation and tracked per stack offset.
+        self.calls = []
+        self.cell_ids = {}
+        self.n_allocations = 0
+        # allocation and free events, in order, for choosing a layout.
+        # layout maps storage ids to the stack offsets to give them
+        self.allocation_events = []
+        self.layout = layout or {}
+
+_literal_matcher = pm.match(L(pm.Star('x')))
+_head_tail_matcher = pm.match(pm.Cons(pm.Star('head'), pm.Star('tail')))
+
+def compile_phase_2(built_in_macros, macro, out = None, source_map = None,
+        n_cells = 30000):
+    """
+    emit brainfuck for macro to out, defaulting to stdout, as it is
+    generated, for a machine with n_cells cells. if source_map is given,
+    a file, the stack of macro and built-in names generating each range
+    of opcodes is written to it (see codegen.write_source_map)
+    """
+
+    if out is None:
+        out = sys.stdout
 
     def lookup_built_in_macro(name):
         return built_in_macros[name]
@@ -136,9 +185,15 @@ def compile_phase_2(built_in_macros, macro):
     # local allocation actions
 
     def do_allocate_local(state):
-        return state.stack_man.allocate_local()
+        x = state.stack_man.allocate_local(state.layout.get(state.n_allocations))
+        state.cell_ids[codegen.match_stack_address(x)] = state.n_allocations
+        state.allocation_events.append(('allocate', state.n_allocations))
+        state.n_allocations += 1
+        return x
 
     def do_free_local(state, x):
+        offset = codegen.match_stack_address(x)
+        state.allocation_events.append(('free', state.cell_ids.pop(offset)))
         return state.stack_man.free_local(x)
 
     def do_free_local_on_env_exit(state, x):
@@ -146,12 +201,43 @@ def compile_phase_2(built_in_macros, macro):
 
     # built in macro call support
     def do_macro_name_lookup(state, name_literal):
-        m = pm.match(L(pm.Star('x'))).attempt_match(name_literal)
+        m = _literal_matcher.attempt_match(name_literal)
         assert m is not None
         return lookup_built_in_macro(m['x'])
 
+    def storage_id(state, x):
+        if not codegen.is_stack_address(x):
+            return None
+        offset = codegen.match_stack_address(x)
+        return state.cell_ids.get(offset, x)
+
     def do_call_macro(state, built_in_macro, args):
-        built_in_macro(state.machine, state.stack_man, *args)
+        i = state.n_calls
+        name = state.lowered.get(i, built_in_macro.__name__)
+        state.n_calls += 1
+        if state.machine is None:
+            state.calls.append((name, [storage_id(state, x) for x in args]))
+            return
+        args = list(args)
+        if i in state.shifted:
+            live = state.shifted[i]
+            args.append([codegen.make_stack_address(offset)
+                for (offset, x) in state.cell_ids.items() if x in live])
+        state.machine.push_source(name)
+        built_in_macros[name](state.machine, state.stack_man, *args)
+        state.machine.pop_source()
+
+    # source map actions
+
+    def do_source_begin(state, name_literal):
+        if state.machine is not None:
+            m = _literal_matcher.attempt_match(name_literal)
+            assert m is not None
+            state.machine.push_source(m['x'])
+
+    def do_source_end(state):
+        if state.machine is not None:
+            state.machine.pop_source()
 
     tag_dispatch = {
         'env_begin' : do_env_begin,
@@ -166,6 +252,8 @@ def compile_phase_2(built_in_macros, macro):
         'free_local_on_env_exit' : do_free_local_on_env_exit,
         'name' : do_macro_name_lookup,
         'call_builtin' : do_call_macro,
+        'source_begin' : do_source_begin,
+        'source_end' : do_source_end,
     }
 
     def default_dispatch(tag, args):
@@ -179,30 +267,51 @@ def compile_phase_2(built_in_macros, macro):
             return default_dispatch(tag, args)
 
     def eval_expr(state, expr):
-        m = pm.match(L(pm.Star('x'))).attempt_match(expr)
+        m = _literal_matcher.attempt_match(expr)
         if m is not None:
             return L(m['x'])
         else:
-            m = pm.match(pm.Cons(pm.Star('head'), pm.Star('tail'))).attempt_match(expr)
+            m = _head_tail_matcher.attempt_match(expr)
             assert m is not None
             args = [eval_expr(state, x) for x in m['tail']]
             return dispatch(state, m['head'], args)
     
     statements = expression.get_macro_statements(macro)
-    for expr in statements:
-        eval_expr(state, expr)
-
-    print(formatted_code(state.machine.code))
-
-def formatted_code(code):
-    code = ''.join(code)
-    line_width = 70
-    lines = []
-    while len(code) > line_width:
-        lines.append(code[:line_width])
-        code = code[line_width:]
-    if code:
-        lines.append(code)
-    return ''.join(list(map(lambda s : s + '\n', lines)))
-
 
+    def run_pass(machine, lowered = None, layout = None, shifted = None):
+        state = CompilerState(
+            current_env = BaseEnv(),
+            stack_man = StackMan(),
+            machine = machine,
+            lowered = lowered,
+            layout = layout,
+            shifted = shifted,
+        )
+        if machine is not None:
+            machine.push_source(expression.get_macro_name(macro))
+        for expr in statements:
+            eval_expr(state, expr)
+        if machine is not None:
+            machine.close()
+        return state
+
+    # find the calls that preserve sources that are never read again,
+    # so they can be replaced by cheaper destructive built-ins
+    record = run_pass(None)
+    lowered = liveness.lower_last_uses(record.calls)
+    # only cells still needed are carried over when the stack shifts
+    shifted = liveness.live_across_shifts(record.calls)
+    # place locals used together near each other
+    cell_layout = layout.choose_layout(record.calls, record.allocation_events)
+    # the next pass only records which cells each loop writes to, so
+    # the last can carry known cell values into loops
+    first_pass = codegen.Machine(n_cells, codegen.NullSink())
+    run_pass(first_pass, lowered, cell_layout, shifted)
+    sink = codegen.LineWrappingSink(out)
+    machine = codegen.Machine(n_cells, sink, first_pass.loop_writes,
+        record_sources = source_map is not None)
+    run_pass(machine, lowered, cell_layout, shifted)
+    out.write('\n')
+    if source_map is not None:
+        codegen.write_source_map(machine.source_map, machine.n_emitted,
+            source_map)
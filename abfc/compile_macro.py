@@ -1,14 +1,16 @@
 import sys
+import argparse
 import importlib
 
-from arch import KNOWN_ARCHS, load_arch
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
-def print_usage_and_die():
-    usage_hint = 'usage: [%s] input_macro.py' % ('|'.join(sorted(KNOWN_ARCHS)))
-    sys.stderr.write(usage_hint + '\n')
-    sys.exit(1)
+import cache
+from arch import KNOWN_ARCHS, load_arch
 
-def compile_macro_for_arch(arch, macro_code):
+def compile_macro_for_arch(arch, macro_code, source_map = None):
     COMPILER_FUNC_NAME = 'test_compile'
     # set up environment to run macro_code inside:
     #   1.  define a global variable 'arch' containing the code fragments for
@@ -19,6 +21,8 @@ def compile_macro_for_arch(arch, macro_code):
     #       environment too. These are the macro definitions
     macro_globals = {'arch' : arch, }
     prelude = __import__('prelude')
+    # forget the macros defined by any earlier call
+    prelude._USER_MACROS.clear()
     prelude_macro_names = [name for name in dir(prelude) if (name and name[0].isupper())]
     for name in prelude_macro_names:
         macro_globals[name] = getattr(prelude, name)
@@ -26,20 +30,65 @@ def compile_macro_for_arch(arch, macro_code):
     # the user macro definitions into some global variables in there somewhere.
     exec(macro_code, macro_globals, macro_globals)
     # finally, add the compiler function to the environment, and run that. output will
-    # be written to stdout
+    # be written to stdout, and the source map, if any, to source_map
     macro_globals[COMPILER_FUNC_NAME] = getattr(prelude, COMPILER_FUNC_NAME)
-    exec('%s()' % COMPILER_FUNC_NAME, macro_globals, macro_globals)
+    # the compiled program runs on a tape of the size it compiles for
+    macro_globals['_source_map'] = source_map
+    macro_globals['_n_cells'] = arch.TAPE_SIZE
+    exec('%s(_source_map, _n_cells)' % COMPILER_FUNC_NAME, macro_globals,
+        macro_globals)
+
+def compile_macro_cached(c, arch, macro_code):
+    """
+    returns the output and source map of compile_macro_for_arch, taking
+    them from cache c if they're there
+    """
+    key = cache.make_key('compile_macro', macro_code, arch)
+    map_key = cache.make_key('compile_macro source map', macro_code, arch)
+    output = c.get(key)
+    source_map = c.get(map_key)
+    if output is not None and source_map is not None:
+        return output.decode('utf-8'), source_map.decode('utf-8')
+    source_map_out = StringIO()
+    output = cache.capture_stdout(compile_macro_for_arch, arch, macro_code,
+        source_map_out)
+    source_map = source_map_out.getvalue()
+    c.put(map_key, source_map.encode('utf-8'))
+    c.put(key, output.encode('utf-8'))
+    return output, source_map
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print_usage_and_die()
-    if sys.argv[1] not in KNOWN_ARCHS:
-        print_usage_and_die()
+    p = argparse.ArgumentParser(
+        description = 'compile macro-language source to brainfuck')
+    arch_group = p.add_mutually_exclusive_group(required = True)
+    for arch_name in sorted(KNOWN_ARCHS):
+        arch_group.add_argument(arch_name, dest = 'arch',
+            action = 'store_const', const = arch_name)
+    p.add_argument('--source-map', metavar = 'FILE',
+        help = 'write the macro and built-in names generating each range '
+            'of opcodes to FILE')
+    p.add_argument('--tape-size', metavar = 'CELLS', type = int,
+        help = 'cells in the tape of the compiled compiler, and of the '
+            'programs it compiles (default 30000)')
+    cache.add_arguments(p)
+    p.add_argument('input', help = 'macro-language source file')
+    args = p.parse_args()
 
-    arch = load_arch(sys.argv[1])
+    arch = load_arch(args.arch, args.tape_size)
     
-    with open(sys.argv[2], 'r') as source_file:
+    with open(args.input, 'r') as source_file:
         macro_code = '\n'.join(source_file.readlines())
     
-    compile_macro_for_arch(arch, macro_code)
+    if args.cache_dir:
+        c = cache.Cache(args.cache_dir, args.cache_size)
+        output, source_map = compile_macro_cached(c, arch, macro_code)
+        if args.source_map:
+            with open(args.source_map, 'w') as source_map_file:
+                source_map_file.write(source_map)
+        sys.stdout.write(output)
+    elif args.source_map:
+        with open(args.source_map, 'w') as source_map:
+            compile_macro_for_arch(arch, macro_code, source_map)
+    else:
+        compile_macro_for_arch(arch, macro_code)
 
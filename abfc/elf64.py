@@ -0,0 +1,579 @@
+"""
+assembles the gnu assembler code generated for the x86_64 archs straight
+into a static ELF64 executable, without gcc or as
+
+only the subset of at&t syntax used by the fragments in arch/ is
+understood: labels, including numeric local labels referred to as 1f
+and 1b, the .globl and .lcomm directives, and a handful of integer
+instructions, with register, immediate, base + index * scale + disp
+and symbol(%rip) operands. anything else raises ValueError.
+
+instructions are encoded as gas encodes them, so the code is the same
+as gcc -nostdlib would build. branches start out with 8 bit
+displacements, and are widened to 32 bits until every target is in
+range.
+
+usage: python abfc/elf64.py input.s -o output
+"""
+
+import os
+import sys
+import struct
+import argparse
+
+BASE_ADDRESS = 0x400000
+PAGE_SIZE = 0x1000
+ELF_HEADER_SIZE = 64
+PROGRAM_HEADER_SIZE = 56
+LCOMM_ALIGNMENT = 16
+
+REGISTERS = {}
+for (i, name) in enumerate(['rax', 'rcx', 'rdx', 'rbx', 'rsp', 'rbp',
+        'rsi', 'rdi']):
+    REGISTERS[name] = (8, i)
+    REGISTERS['e' + name[1:]] = (4, i)
+for i in range(8, 16):
+    REGISTERS['r%d' % i] = (8, i)
+    REGISTERS['r%dd' % i] = (4, i)
+    REGISTERS['r%db' % i] = (1, i)
+for (i, name) in enumerate(['al', 'cl', 'dl', 'bl']):
+    REGISTERS[name] = (1, i)
+
+SUFFIX_SIZES = {'b' : 1, 'l' : 4, 'q' : 8}
+
+# the /digit of the 0x80 - 0x83 immediate forms. the register forms
+# of each are at 8 times that
+ALU_OPS = {'add' : 0, 'or' : 1, 'and' : 4, 'sub' : 5, 'xor' : 6, 'cmp' : 7}
+
+CONDITION_CODES = {
+    'o' : 0x0, 'no' : 0x1, 'b' : 0x2, 'c' : 0x2, 'nae' : 0x2,
+    'ae' : 0x3, 'nb' : 0x3, 'nc' : 0x3, 'e' : 0x4, 'z' : 0x4,
+    'ne' : 0x5, 'nz' : 0x5, 'be' : 0x6, 'na' : 0x6, 'a' : 0x7,
+    'nbe' : 0x7, 's' : 0x8, 'ns' : 0x9, 'p' : 0xa, 'pe' : 0xa,
+    'np' : 0xb, 'po' : 0xb, 'l' : 0xc, 'nge' : 0xc, 'ge' : 0xd,
+    'nl' : 0xd, 'le' : 0xe, 'ng' : 0xe, 'g' : 0xf, 'nle' : 0xf,
+}
+
+def _parse_int(s):
+    s = s.strip()
+    sign = 1
+    if s.startswith('-'):
+        sign = -1
+        s = s[1:]
+    if s.startswith('0x') or s.startswith('0X'):
+        return sign * int(s[2:], 16)
+    if len(s) > 1 and s.startswith('0'):
+        return sign * int(s[1:], 8)
+    return sign * int(s)
+
+def _split_operands(s):
+    # split on the commas outside parentheses
+    operands = []
+    depth = 0
+    current = ''
+    for c in s:
+        if c == ',' and depth == 0:
+            operands.append(current.strip())
+            current = ''
+            continue
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        current += c
+    if current.strip():
+        operands.append(current.strip())
+    return operands
+
+def _register(s):
+    if not s.startswith('%') or s[1:] not in REGISTERS:
+        raise ValueError('unknown register "%s"' % s)
+    return REGISTERS[s[1:]]
+
+def _parse_operand(s):
+    """
+    returns one of
+        ('imm', value)
+        ('reg', size, number)
+        ('mem', disp, base, index, scale), with None for a missing
+            base or index
+        ('rip', symbol, addend)
+        ('label', name)
+    """
+    if s.startswith('$'):
+        return ('imm', _parse_int(s[1:]))
+    if s.startswith('%'):
+        return ('reg', ) + _register(s)
+    if '(' in s:
+        (disp, rest) = s.split('(', 1)
+        if not rest.endswith(')'):
+            raise ValueError('bad memory operand "%s"' % s)
+        parts = [x.strip() for x in rest[:-1].split(',')]
+        if parts[0] == '%rip':
+            if len(parts) != 1:
+                raise ValueError('bad memory operand "%s"' % s)
+            (symbol, plus, addend) = disp.strip().partition('+')
+            return ('rip', symbol.strip(), _parse_int(addend) if plus else 0)
+        disp = _parse_int(disp) if disp.strip() else 0
+        base = _register(parts[0]) if parts[0] else None
+        index = _register(parts[1]) if len(parts) > 1 else None
+        scale = _parse_int(parts[2]) if len(parts) > 2 else 1
+        for r in (base, index):
+            if r is not None and r[0] != 8:
+                raise ValueError('bad memory operand "%s"' % s)
+        if (index is not None and index[1] == 4) or scale not in (1, 2, 4, 8):
+            raise ValueError('bad memory operand "%s"' % s)
+        return ('mem', disp, base and base[1], index and index[1], scale)
+    return ('label', s)
+
+def _fits_in_8(n):
+    return -128 <= n <= 127
+
+def _fits_in_32(n):
+    return -2 ** 31 <= n < 2 ** 31
+
+class Code:
+    """
+    bytes of an instruction, with the symbol and addend its rip-relative
+    displacement refers to, if any, and the offset of the displacement
+    """
+    def __init__(self, data, symbol = None, disp_offset = None, addend = 0):
+        self.data = data
+        self.symbol = symbol
+        self.disp_offset = disp_offset
+        self.addend = addend
+
+    def size(self):
+        return len(self.data)
+
+class Branch:
+    """
+    a jmp, jcc or call to a label, which is encoded once the label's
+    address is known
+    """
+    def __init__(self, kind, cc, target):
+        self.kind = kind
+        self.cc = cc
+        self.target = target
+        # calls have no short form
+        self.short = (kind != 'call')
+
+    def size(self):
+        if self.short:
+            return 2
+        return 6 if self.kind == 'jcc' else 5
+
+    def encode(self, rel):
+        if self.short:
+            op = bytearray([0xeb if self.kind == 'jmp' else 0x70 + self.cc])
+            return op + struct.pack('<b', rel)
+        if self.kind == 'jcc':
+            op = bytearray([0x0f, 0x80 + self.cc])
+        else:
+            op = bytearray([0xe9 if self.kind == 'jmp' else 0xe8])
+        return op + struct.pack('<i', rel)
+
+def _modrm(reg, rm, size, opcode, imm = b''):
+    """
+    encodes opcode, bytes, with a modrm byte giving reg, a register
+    number or /digit, and rm, a register or memory operand. size is
+    the operand size, for REX.W.
+    """
+    rex = 0x48 if size == 8 else 0x40
+    rex |= (reg >> 3) << 2
+    (symbol, addend) = (None, 0)
+    if rm[0] == 'reg':
+        rex |= rm[2] >> 3
+        modrm = bytearray([0xc0 | (reg & 7) << 3 | (rm[2] & 7)])
+    elif rm[0] == 'rip':
+        (symbol, addend) = rm[1:]
+        modrm = bytearray([(reg & 7) << 3 | 5]) + struct.pack('<i', 0)
+    else:
+        (disp, base, index, scale) = rm[1:]
+        if base is None:
+            raise ValueError('memory operands need a base register')
+        rex |= base >> 3
+        if index is not None:
+            rex |= (index >> 3) << 1
+        if disp == 0 and (base & 7) != 5:
+            (mod, disp_bytes) = (0, b'')
+        elif _fits_in_8(disp):
+            (mod, disp_bytes) = (1, struct.pack('<b', disp))
+        elif _fits_in_32(disp):
+            (mod, disp_bytes) = (2, struct.pack('<i', disp))
+        else:
+            raise ValueError('displacement %d out of range' % disp)
+        if index is None and (base & 7) != 4:
+            modrm = bytearray([mod << 6 | (reg & 7) << 3 | (base & 7)])
+        else:
+            sib_index = 4 if index is None else index & 7
+            sib = {1 : 0, 2 : 1, 4 : 2, 8 : 3}[scale] << 6
+            sib |= sib_index << 3 | (base & 7)
+            modrm = bytearray([mod << 6 | (reg & 7) << 3 | 4, sib])
+        modrm += disp_bytes
+    prefix = bytearray([rex]) if rex != 0x40 else bytearray()
+    data = prefix + bytearray(opcode) + modrm + bytearray(imm)
+    if symbol is None:
+        return Code(data)
+    disp_offset = len(prefix) + len(opcode) + 1
+    return Code(data, symbol, disp_offset, addend)
+
+def _imm(value, size):
+    if size == 1:
+        return struct.pack('<B', value & 0xff)
+    if not _fits_in_32(value) and not (size == 4 and 0 <= value < 2 ** 32):
+        raise ValueError('immediate %d out of range' % value)
+    return struct.pack('<I', value & 0xffffffff)
+
+def _check_size(size, operands):
+    for op in operands:
+        if op[0] == 'reg' and op[1] != size:
+            raise ValueError('operand size mismatch')
+
+def _alu(name, size, operands):
+    (src, dst) = operands
+    _check_size(size, operands)
+    n = ALU_OPS[name]
+    byte = (size == 1)
+    if src[0] == 'imm':
+        if byte:
+            return _modrm(n, dst, size, [0x80], _imm(src[1], 1))
+        if _fits_in_8(src[1]):
+            return _modrm(n, dst, size, [0x83], struct.pack('<b', src[1]))
+        return _modrm(n, dst, size, [0x81], _imm(src[1], size))
+    if src[0] == 'reg':
+        return _modrm(src[2], dst, size, [8 * n + (0 if byte else 1)])
+    if dst[0] == 'reg':
+        return _modrm(dst[2], src, size, [8 * n + (2 if byte else 3)])
+    raise ValueError('bad operands')
+
+def _mov(name, size, operands):
+    (src, dst) = operands
+    _check_size(size, operands)
+    byte = (size == 1)
+    if src[0] == 'imm':
+        return _modrm(0, dst, size, [0xc6 if byte else 0xc7],
+            _imm(src[1], size))
+    if src[0] == 'reg':
+        return _modrm(src[2], dst, size, [0x88 if byte else 0x89])
+    if dst[0] == 'reg':
+        return _modrm(dst[2], src, size, [0x8a if byte else 0x8b])
+    raise ValueError('bad operands')
+
+def _test(name, size, operands):
+    (src, dst) = operands
+    _check_size(size, operands)
+    byte = (size == 1)
+    if src[0] == 'imm':
+        return _modrm(0, dst, size, [0xf6 if byte else 0xf7],
+            _imm(src[1], size))
+    if src[0] == 'reg':
+        return _modrm(src[2], dst, size, [0x84 if byte else 0x85])
+    raise ValueError('bad operands')
+
+def _inc_dec(name, size, operands):
+    (dst, ) = operands
+    _check_size(size, operands)
+    n = {'inc' : 0, 'dec' : 1}[name]
+    return _modrm(n, dst, size, [0xfe if size == 1 else 0xff])
+
+def _lea(name, size, operands):
+    (src, dst) = operands
+    _check_size(size, [dst])
+    if src[0] not in ('mem', 'rip') or dst[0] != 'reg':
+        raise ValueError('bad operands')
+    return _modrm(dst[2], src, size, [0x8d])
+
+def _movzb(name, size, operands):
+    (src, dst) = operands
+    if (src[0] == 'reg' and src[1] != 1) or dst[0] != 'reg':
+        raise ValueError('bad operands')
+    _check_size(size, [dst])
+    return _modrm(dst[2], src, size, [0x0f, 0xb6])
+
+def _imul(name, size, operands):
+    _check_size(size, operands[1:])
+    if len(operands) == 2:
+        (src, dst) = operands
+        return _modrm(dst[2], src, size, [0x0f, 0xaf])
+    (factor, src, dst) = operands
+    if factor[0] != 'imm' or dst[0] != 'reg':
+        raise ValueError('bad operands')
+    if _fits_in_8(factor[1]):
+        return _modrm(dst[2], src, size, [0x6b], struct.pack('<b', factor[1]))
+    return _modrm(dst[2], src, size, [0x69], _imm(factor[1], size))
+
+def _push_pop(name, size, operands):
+    (reg, ) = operands
+    if size != 8 or reg[0] != 'reg' or reg[1] != 8:
+        raise ValueError('bad operands')
+    op = {'push' : 0x50, 'pop' : 0x58}[name] + (reg[2] & 7)
+    return Code(bytearray([0x41, op] if reg[2] >= 8 else [op]))
+
+def _call_indirect(operand):
+    # call *%reg or call *disp(%base)
+    rm = _parse_operand(operand)
+    if rm[0] not in ('reg', 'mem') or (rm[0] == 'reg' and rm[1] != 8):
+        raise ValueError('bad operands')
+    return _modrm(2, rm, 4, [0xff])
+
+# mnemonics taking an operand size suffix
+SIZED_INSTRUCTIONS = {
+    'mov' : _mov,
+    'test' : _test,
+    'inc' : _inc_dec,
+    'dec' : _inc_dec,
+    'lea' : _lea,
+    'imul' : _imul,
+    'push' : _push_pop,
+    'pop' : _push_pop,
+}
+for name in ALU_OPS:
+    SIZED_INSTRUCTIONS[name] = _alu
+
+FIXED_INSTRUCTIONS = {
+    'syscall' : bytearray([0x0f, 0x05]),
+    'ret' : bytearray([0xc3]),
+}
+
+def _encode(mnemonic, operands):
+    if mnemonic in FIXED_INSTRUCTIONS:
+        return Code(FIXED_INSTRUCTIONS[mnemonic])
+    if mnemonic == 'call' and operands.startswith('*'):
+        return _call_indirect(operands[1:])
+    if mnemonic in ('jmp', 'call'):
+        return Branch(mnemonic, None, operands)
+    if mnemonic[0] == 'j' and mnemonic[1:] in CONDITION_CODES:
+        return Branch('jcc', CONDITION_CODES[mnemonic[1:]], operands)
+    operands = [_parse_operand(op) for op in _split_operands(operands)]
+    if mnemonic in ('movzbl', 'movzbq'):
+        return _movzb(mnemonic, SUFFIX_SIZES[mnemonic[-1]], operands)
+    (name, suffix) = (mnemonic[:-1], mnemonic[-1])
+    if name in SIZED_INSTRUCTIONS and suffix in SUFFIX_SIZES:
+        return SIZED_INSTRUCTIONS[name](name, SUFFIX_SIZES[suffix], operands)
+    raise ValueError('unknown instruction "%s"' % mnemonic)
+
+class Assembler:
+    """
+    turns lines of assembly into a list of Code, Branch and label
+    items, then lays them out
+    """
+    def __init__(self):
+        # runs of straight-line code are merged into one Code item
+        self.items = []
+        self.labels = {}
+        self.bss = []
+        self.bss_size = 0
+        # the number of times each numeric local label has been defined
+        self.local_counts = {}
+        # encodings of the lines without symbols, which repeat a lot
+        self.encoded = {}
+        self.offsets = None
+
+    def local_label(self, name):
+        # numeric labels may be defined many times. 1b refers to the
+        # last 1, 1f to the next
+        if name[:-1].isdigit() and name[-1] in 'bf':
+            n = name[:-1]
+            k = self.local_counts.get(n, 0) - (1 if name[-1] == 'b' else 0)
+            return '%s#%d' % (n, k)
+        return name
+
+    def define_label(self, name):
+        if name.isdigit():
+            k = self.local_counts.get(name, 0)
+            self.local_counts[name] = k + 1
+            name = '%s#%d' % (name, k)
+        if name in self.labels:
+            raise ValueError('label "%s" defined twice' % name)
+        self.labels[name] = len(self.items)
+        self.items.append(None)
+
+    def directive(self, name, args):
+        if name == '.globl':
+            return
+        if name == '.lcomm':
+            (symbol, size) = _split_operands(args)
+            self.bss_size += -self.bss_size % LCOMM_ALIGNMENT
+            self.bss.append((symbol, self.bss_size))
+            self.bss_size += _parse_int(size)
+            return
+        raise ValueError('unknown directive "%s"' % name)
+
+    def append_code(self, data):
+        last = self.items and self.items[-1]
+        if isinstance(last, Code) and last.symbol is None:
+            last.data += data
+        else:
+            self.items.append(Code(bytearray(data)))
+
+    def line(self, s):
+        if s in self.encoded:
+            self.append_code(self.encoded[s])
+            return
+        line = s
+        s = s.split('#', 1)[0].strip()
+        while s:
+            head = s.split(None, 1)[0]
+            if ':' in head:
+                (label, s) = s.split(':', 1)
+                self.define_label(label.strip())
+                s = s.strip()
+                continue
+            rest = s[len(head):].strip()
+            if head.startswith('.'):
+                self.directive(head, rest)
+                return
+            item = _encode(head, rest)
+            if isinstance(item, Branch):
+                item.target = self.local_label(item.target)
+                self.items.append(item)
+            elif item.symbol is not None:
+                self.items.append(item)
+            else:
+                if line.strip() == s:
+                    self.encoded[line] = item.data
+                self.append_code(item.data)
+            return
+
+    def layout(self):
+        """
+        finds the offset of each item, widening branches until all of
+        their targets are in range
+        """
+        items = self.items
+        labels = self.labels
+        branches = []
+        for (i, item) in enumerate(items):
+            if isinstance(item, Branch):
+                if item.target not in labels:
+                    raise ValueError('undefined label "%s"' % item.target)
+                branches.append((i, item, labels[item.target]))
+        sizes = [0 if item is None else item.size() for item in items]
+        while True:
+            offsets = [0]
+            offset = 0
+            for size in sizes:
+                offset += size
+                offsets.append(offset)
+            widened = False
+            for (i, item, target) in branches:
+                if item.short and not _fits_in_8(offsets[target] -
+                        offsets[i + 1]):
+                    item.short = False
+                    sizes[i] = item.size()
+                    widened = True
+            if not widened:
+                self.offsets = offsets
+                return
+
+    def text_size(self):
+        if self.offsets is None:
+            self.layout()
+        return self.offsets[-1]
+
+    def text(self, text_address, bss_address):
+        """
+        returns the code, and the address of each symbol, for the code
+        and bss placed at the given addresses
+        """
+        if self.offsets is None:
+            self.layout()
+        offsets = self.offsets
+        symbols = {}
+        for (name, i) in self.labels.items():
+            symbols[name] = text_address + offsets[i]
+        for (name, offset) in self.bss:
+            symbols[name] = bss_address + offset
+        code = bytearray()
+        for (i, item) in enumerate(self.items):
+            if item is None:
+                continue
+            end = offsets[i + 1]
+            if isinstance(item, Branch):
+                code += item.encode(offsets[self.labels[item.target]] - end)
+                continue
+            data = item.data
+            if item.symbol is not None:
+                if item.symbol not in symbols:
+                    raise ValueError('undefined symbol "%s"' % item.symbol)
+                rel = (symbols[item.symbol] + item.addend -
+                    (text_address + end))
+                data = bytearray(data)
+                struct.pack_into('<i', data, item.disp_offset, rel)
+            code += data
+        return (code, symbols)
+
+def parse(source):
+    """
+    returns an Assembler holding source, a string of assembly
+    """
+    a = Assembler()
+    for (i, line) in enumerate(source.split('\n')):
+        try:
+            a.line(line)
+        except (ValueError, KeyError, IndexError) as e:
+            raise ValueError('line %d : %s : %s' % (i + 1, e, line.strip()))
+    return a
+
+def assemble(source):
+    """
+    returns the bytes of a static ELF64 executable for source, a string
+    of assembly, starting at _start
+    """
+    a = parse(source)
+
+    n_headers = 3 if a.bss_size else 2
+    text_offset = ELF_HEADER_SIZE + n_headers * PROGRAM_HEADER_SIZE
+    text_address = BASE_ADDRESS + text_offset
+    bss_address = text_address + a.text_size()
+    bss_address += -bss_address % PAGE_SIZE
+    (code, symbols) = a.text(text_address, bss_address)
+    if '_start' not in symbols:
+        raise ValueError('no _start label')
+
+    PT_LOAD = 1
+    PT_GNU_STACK = 0x6474e551
+    (PF_X, PF_W, PF_R) = (1, 2, 4)
+    headers = [
+        (PT_LOAD, PF_R | PF_X, 0, BASE_ADDRESS, text_offset + len(code),
+            text_offset + len(code), PAGE_SIZE),
+    ]
+    if a.bss_size:
+        headers.append((PT_LOAD, PF_R | PF_W, 0, bss_address, 0, a.bss_size,
+            PAGE_SIZE))
+    headers.append((PT_GNU_STACK, PF_R | PF_W, 0, 0, 0, 0, 16))
+
+    ident = b'\x7fELF' + bytearray([2, 1, 1, 0]) + b'\0' * 8
+    # ET_EXEC, EM_X86_64, EV_CURRENT, entry, phoff, shoff, flags,
+    # ehsize, phentsize, phnum, shentsize, shnum, shstrndx
+    elf = ident + struct.pack('<HHIQQQIHHHHHH', 2, 62, 1, symbols['_start'],
+        ELF_HEADER_SIZE, 0, 0, ELF_HEADER_SIZE, PROGRAM_HEADER_SIZE,
+        len(headers), 0, 0, 0)
+    for (p_type, flags, offset, address, file_size, mem_size, align) in headers:
+        elf += struct.pack('<IIQQQQQQ', p_type, flags, offset, address,
+            address, file_size, mem_size, align)
+    return bytes(elf + code)
+
+def die(s):
+    sys.stderr.write(s + '\n')
+    sys.exit(1)
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(
+        description = 'assemble x86_64 code generated by abfc into a '
+            'static ELF64 executable')
+    p.add_argument('-o', dest = 'output', required = True,
+        help = 'executable to write')
+    p.add_argument('input', help = 'gnu assembler source file')
+    args = p.parse_args()
+
+    with open(args.input, 'r') as f:
+        source = f.read()
+    try:
+        elf = assemble(source)
+    except ValueError as e:
+        die('error: %s : %s' % (args.input, e))
+    with open(args.output, 'wb') as f:
+        f.write(elf)
+    os.chmod(args.output, 0o755)
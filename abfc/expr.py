@@ -1,13 +1,18 @@
 from sugar import *
 import pattern_match as pm
 
+_literal_matcher = pm.match(L(pm.Star('x')))
+_head_tail_matcher = pm.match(pm.Cons(pm.Star('head'), pm.Star('tail')))
+_params_matcher = pm.match(pm.Cons('parameters', pm.Star('p')))
+_name_matcher = pm.match(NAME(pm.Star('x')))
+
 def expr_print(expr, indent = 0):
     prefix = '. ' * indent
-    m = pm.match(L(pm.Star('x'))).attempt_match(expr)
+    m = _literal_matcher.attempt_match(expr)
     if m is not None:
         print('%sL %s' % (prefix, str(m['x'])))
     else:
-        m = pm.match(pm.Cons(pm.Star('head'), pm.Star('tail'))).attempt_match(expr)
+        m = _head_tail_matcher.attempt_match(expr)
         assert m is not None
         print('%sE %s' % (prefix, str(m['head'])))
         for x in m['tail']:
@@ -21,10 +26,16 @@ def match_user_macro_body(f):
         ).replace(f)
 
 
+@match_user_macro_body
+def get_macro_name(name, params, statements):
+    m = _name_matcher.attempt_match(name)
+    assert m
+    return m['x']
+
+
 @match_user_macro_body
 def get_macro_param_names(name, params, statements):
-    match_params = pm.match(pm.Cons('parameters', pm.Star('p')))
-    m = match_params.attempt_match(params)
+    m = _params_matcher.attempt_match(params)
     assert m
     return m['p']
 
@@ -41,140 +52,192 @@ def wrap_body_in_env_rule(name, params, statements):
     return ('user_macro', name, params, BODY(*statements_prime))
 
 
-@match_user_macro_body
-def allocate_locals_rule(name, params, statements):
-    f = pm.match((LOCAL(pm.Star('x')),)).replace(lambda x : (
-            ('env_declare', L(x)),
-            ('env_set', L(x), ('allocate_local', )),
-            ('free_local_on_env_exit', ('env_get', L(x))),
-        ))
-    statements_prime = []
-    for expr in statements:
-        statements_prime += list(f([expr]))
-    return ('user_macro', name, params, BODY(*statements_prime))
-
-
-@match_user_macro_body
-def expand_while_block_rule(name, params, statements):
-    def rewrite_while_block(x, statements):
-        return tuple(
-            [('env_begin', ),
-            BEGIN_LOOP(x)] +
-            statements +
-            [END_LOOP(x),
-            ('env_end', )]
-        )
-    f = (pm.match(
-            (('while', ARGS(pm.Star('x')), pm.Cons('body', pm.Star('statements'))), )
-        ).replace(rewrite_while_block))
-    statements_prime = []
-    for expr in statements:
-        statements_prime += list(f([expr]))
-    return ('user_macro', name, params, BODY(*statements_prime))
-
-
-@match_user_macro_body
-def expand_if_block_rule(name, params, statements):
-    def rewrite_if_block(x, statements):
-        # use HIDDEN variable so it has distinct name from user variables
-        # also, note that the if block is wrapped in its own scope.
-        t = HIDDEN('if_tmp')
-        return tuple(
-            [('env_begin', ),
-            LOCAL(t),
-            COPY(x, t),
-            BEGIN_LOOP(t), ] +
-            statements +
-            [CLEAR(t),
-            END_LOOP(t),
-            ('env_end', ), ]
-        )
-    f = (pm.match(
-            (('if', ARGS(pm.Star('x')), pm.Cons('body', pm.Star('statements'))), )
-        ).replace(rewrite_if_block))
+# statement rules: each takes a single statement and returns the list of
+# statements replacing it, or None if the statement doesn't match
+
+def match_statement(pattern):
+    matcher = pm.match(pattern)
+    def _decorator(f):
+        def _rule(expr):
+            m = matcher.attempt_match(expr)
+            if m is None:
+                return None
+            return f(**m)
+        return _rule
+    return _decorator
+
+
+@match_statement(LOCAL(pm.Star('x')))
+def allocate_local_rule(x):
+    return [
+        ('env_declare', L(x)),
+        ('env_set', L(x), ('allocate_local', )),
+        ('free_local_on_env_exit', ('env_get', L(x))),
+    ]
+
+
+@match_statement(('while', ARGS(pm.Star('x')), pm.Cons('body', pm.Star('statements'))))
+def expand_while_block_rule(x, statements):
+    return (
+        [('env_begin', ),
+        BEGIN_LOOP(x)] +
+        statements +
+        [END_LOOP(x),
+        ('env_end', )]
+    )
+
+
+@match_statement(('if', ARGS(pm.Star('x')), pm.Cons('body', pm.Star('statements'))))
+def expand_if_block_rule(x, statements):
+    # use HIDDEN variable so it has distinct name from user variables
+    # also, note that the if block is wrapped in its own scope.
+    t = HIDDEN('if_tmp')
+    return (
+        [('env_begin', ),
+        LOCAL(t),
+        COPY(x, t),
+        BEGIN_LOOP(t), ] +
+        statements +
+        [CLEAR(t),
+        END_LOOP(t),
+        ('env_end', ), ]
+    )
+
+
+def _head_tag(expr):
+    if isinstance(expr, tuple) and expr and isinstance(expr[0], str):
+        return expr[0]
+    return None
+
+
+def rewrite_statements(statements, rules, applied = None):
+    """
+    rewrite statements until none of them match any of rules, a dict
+    of statement rules keyed by the head tag of the statements they
+    apply to. statements produced by a rewrite are themselves
+    revisited, in place, but nothing else is.
+    returns the rewritten statements. the tags of the rules that were
+    applied are added to applied, if given.
+    """
     statements_prime = []
-    for expr in statements:
-        statements_prime += list(f([expr]))
-    return ('user_macro', name, params, BODY(*statements_prime))
-
-def expand_macro_call(macro, substitutions):
+    worklist = list(reversed(statements))
+    while worklist:
+        expr = worklist.pop()
+        tag = _head_tag(expr)
+        replacement = None
+        if tag in rules:
+            replacement = rules[tag](expr)
+        if replacement is None:
+            statements_prime.append(expr)
+        else:
+            if applied is not None:
+                applied.add(tag)
+            worklist.extend(reversed(replacement))
+    return statements_prime
+
+def expand_macro_call(param_names, statements, args):
+    """
+    returns the statements inlining a call to a macro with the given
+    parameter names and body statements, binding args to the parameters
+    """
+    assert len(args) == len(param_names)
+    substitutions = dict(zip(param_names, args))
+
+    header = [('env_begin', )]
+    for x in param_names:
+        header += [
+            ('env_declare', x),
+            ('env_set', x, ('outer_env_get', substitutions[x])),
+        ]
+
+    footer = [('env_end', )]
+
+    return header + statements + footer
+
+
+_call_macro_matcher = pm.match(
+    ('call_macro', NAME(pm.Star('macro_name')), pm.Cons('arguments', pm.Star('args'))))
+
+def match_macro_call(expr):
+    if _head_tag(expr) != 'call_macro':
+        return None
+    return _call_macro_matcher.attempt_match(expr)
+
+
+def macro_expansion_order(user_macro_definitions, macro_name):
+    """
+    returns the names of macro_name and all the macros it calls,
+    directly or not, ordered so that each macro comes after every
+    macro it calls.
+    raises ValueError if macros call each other recursively, as such
+    calls could never be fully inlined.
+    """
+    order = []
+    path = []
+    def visit(name):
+        if name in path:
+            cycle = path[path.index(name):] + [name]
+            raise ValueError('recursive macro call : %s' % ' -> '.join(cycle))
+        if name in order:
+            return
+        path.append(name)
+        for expr in get_macro_statements(user_macro_definitions[name]):
+            m = match_macro_call(expr)
+            if m is not None:
+                visit(m['macro_name'])
+        path.pop()
+        order.append(name)
+    visit(macro_name)
+    return order
+
+
+def expand_all_macro_calls(user_macro_definitions, macro_name):
+    """
+    inline all macro calls in macro_name. the macros are expanded
+    bottom up, so each macro's body is expanded once and then copied
+    into every call site. each inlined call is bracketed by
+    source_begin and source_end markers naming the macro, for source
+    maps.
+    """
+    expanded = {}
+    for name in macro_expansion_order(user_macro_definitions, macro_name):
+        macro = user_macro_definitions[name]
+        statements = []
+        for expr in get_macro_statements(macro):
+            m = match_macro_call(expr)
+            if m is None:
+                statements.append(expr)
+            else:
+                param_names, body = expanded[m['macro_name']]
+                statements.append(('source_begin', L(m['macro_name'])))
+                statements += expand_macro_call(param_names, body, m['args'])
+                statements.append(('source_end', ))
+        expanded[name] = (get_macro_param_names(macro), statements)
 
     @match_user_macro_body
-    def rewrite_macro(name, params, statements):
-        # extract parameter names
-        match_params = pm.match(pm.Cons('parameters', pm.Star('p')))
-        m = match_params.attempt_match(params)
-        param_names = m['p']
-
-        assert len(param_names) == len(substitutions)
-
-        header = [('env_begin', )]
-        for x in param_names:
-            assert x in substitutions
-            header += [
-                ('env_declare', x),
-                ('env_set', x, ('outer_env_get', substitutions[x])),
-            ]
-
-        footer = [('env_end', )]
-
-        statements_prime = header + statements + footer
-        params_prime = []
-        return ('user_macro', name, params_prime, BODY(*statements_prime))
+    def replace_body(name, params, statements):
+        return ('user_macro', name, params, BODY(*expanded[macro_name][1]))
 
-    return rewrite_macro(macro)
+    return replace_body(user_macro_definitions[macro_name])
 
-
-def make_expand_all_macro_calls_rule(user_macro_definitions):
-    @match_user_macro_body
-    def expand_all_macro_calls_rule(name, params, statements):
-
-        def inline_macro(macro_name, args):
-            """
-            returns statments from expanded macro using given arguments
-            """
-            macro = user_macro_definitions[macro_name]
-            params = get_macro_param_names(macro)
-            assert len(args) == len(params)
-            substitutions = dict(zip(params, args))
-            expanded_macro = expand_macro_call(macro, substitutions)
-            return get_macro_statements(expanded_macro)
-
-        f = (pm.match(
-                (
-                    ('call_macro',
-                        NAME(pm.Star('macro_name')),
-                        pm.Cons('arguments',
-                        pm.Star('args')),
-                    ),
-                )
-            ).replace(inline_macro))
-        
-        statements_prime = []
-        for expr in statements:
-            statements_prime += list(f([expr]))
-        return ('user_macro', name, params, BODY(*statements_prime))
-
-    return expand_all_macro_calls_rule
+STATEMENT_RULES = {
+    'local' : allocate_local_rule,
+    'while' : expand_while_block_rule,
+    'if' : expand_if_block_rule,
+}
 
 def rewrite_macro_until_fixed_point(macro, verbose):
-    transforms = {
-        'allocate_locals' : allocate_locals_rule,
-        'expand_while_block' : expand_while_block_rule,
-        'expand_if_block' : expand_if_block_rule,
-    }
-    
-    changed = True
-    while changed:
-        changed = False
-        for transform_name in sorted(transforms):
-            macro_out = transforms[transform_name](macro)
-            if macro_out != macro:
-                if verbose:
-                    print('> applied transform "%s"' % transform_name)
-                changed = True
-            macro = macro_out
-    return wrap_body_in_env_rule(macro)
+    @match_user_macro_body
+    def rewrite_macro(name, params, statements):
+        # the worklist revisits everything it rewrites, so one pass
+        # reaches the fixed point
+        applied = set()
+        statements = rewrite_statements(statements, STATEMENT_RULES, applied)
+        if verbose:
+            for tag in sorted(applied):
+                print('> applied rule for "%s"' % tag)
+        return ('user_macro', name, params, BODY(*statements))
+    return wrap_body_in_env_rule(rewrite_macro(macro))
 
 def compile_macro(macro_defns, macro_name, verbose = False):
     rewritten_macros = {}
@@ -184,14 +247,6 @@ def compile_macro(macro_defns, macro_name, verbose = False):
         rewritten_macros[name] = rewrite_macro_until_fixed_point(macro_defns[name],
             verbose)
     
-    expand_all_macro_calls_rule = make_expand_all_macro_calls_rule(rewritten_macros)
-
-    macro = rewritten_macros[macro_name]
-    changed = True
     if verbose:
         print('>>> inlining macro calls in main macro')
-    while changed:
-        macro_out = expand_all_macro_calls_rule(macro)
-        changed = (macro_out != macro)
-        macro = macro_out
-    return macro
+    return expand_all_macro_calls(rewritten_macros, macro_name)
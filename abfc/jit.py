@@ -0,0 +1,251 @@
+"""
+runs brainfuck programs in-process at native speed, on x86_64
+
+the program is compiled by bootstrap_bf.py, through the x86_64
+fragments, and assembled by elf64.py into an executable mmap region,
+which is called through ctypes. nothing is written to disk, and
+neither gcc nor as is needed.
+
+the generated code is a function
+
+    long bf_main(unsigned char *tape, struct io *io)
+
+returning the final data pointer. the fragments are used as they are,
+except that the tape is addressed through %r12 rather than %rsp, so
+the code runs on the caller's stack, and i/o goes through buffers in
+the io struct, calling back into python to flush output when the
+buffer is full and to refill input when it's empty.
+
+the data pointer isn't checked, so as with the assembled programs, a
+program moving off either end of the tape may crash.
+
+run with no arguments to see usage. the program reads from stdin and
+writes to stdout.
+"""
+
+import os
+import sys
+import mmap
+import ctypes
+import argparse
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import bf_ir
+import elf64
+import bootstrap_bf
+from arch import x86_64
+
+DEFAULT_N_CELLS = 30000
+IO_BUFFER_SIZE = 65536
+
+TAPE_REGISTER = '%r12'
+
+FLUSH = ctypes.CFUNCTYPE(None, ctypes.c_void_p)
+FILL = ctypes.CFUNCTYPE(None, ctypes.c_void_p)
+
+class Io(ctypes.Structure):
+    _fields_ = [
+        ('inbuf', ctypes.c_void_p),     # 0
+        ('in_len', ctypes.c_int64),     # 8
+        ('in_pos', ctypes.c_int64),     # 16
+        ('outbuf', ctypes.c_void_p),    # 24
+        ('out_len', ctypes.c_int64),    # 32
+        ('out_pos', ctypes.c_int64),    # 40
+        ('flush', FLUSH),               # 48
+        ('fill', FILL),                 # 56
+    ]
+
+# convention : %rbx holds dp, as in the x86_64 fragments
+#              %r12 holds the address of the tape
+#              %r13 holds the address of the io struct
+#
+#   note :     the three pushes keep %rsp 16 byte aligned for the
+#              callbacks, as the call to bf_main left it 8 bytes off
+PROGRAM_START = r"""
+.globl _start
+_start:
+    pushq	%rbx
+    pushq	%r12
+    pushq	%r13
+    movq	%rdi,%r12
+    movq	%rsi,%r13
+    movq	$0,%rbx"""
+
+PROGRAM_END = r"""
+    movq	%rbx,%rax
+    popq	%r13
+    popq	%r12
+    popq	%rbx
+    ret
+"""
+
+# buffer[dp] -> io->outbuf[io->out_pos++], calling io->flush(io) when
+# the buffer is full
+WRITE_CHAR = r"""
+    movb	0(%r12, %rbx, 1),%al
+    movq	24(%r13),%rcx
+    movq	40(%r13),%rdx
+    movb	%al,0(%rcx, %rdx, 1)
+    incq	%rdx
+    movq	%rdx,40(%r13)
+    cmpq	32(%r13),%rdx
+    jne		1f
+    movq	%r13,%rdi
+    call	*48(%r13)
+1:"""
+
+# io->inbuf[io->in_pos++] -> buffer[dp], calling io->fill(io) when the
+# buffer is empty. if it's still empty, that's eof, and buffer[dp] is
+# left unchanged, as with a bare read.
+READ_CHAR = r"""
+    movq	16(%r13),%rdx
+    cmpq	8(%r13),%rdx
+    jb		1f
+    movq	%r13,%rdi
+    call	*56(%r13)
+    movq	16(%r13),%rdx
+    cmpq	8(%r13),%rdx
+    jae		2f
+1:
+    movq	0(%r13),%rcx
+    movb	0(%rcx, %rdx, 1),%al
+    movb	%al,0(%r12, %rbx, 1)
+    incq	%rdx
+    movq	%rdx,16(%r13)
+2:"""
+
+class _Fragments:
+    pass
+
+def jit_fragments():
+    """
+    returns the x86_64 fragments, with the tape addressed through
+    TAPE_REGISTER and the program start, end and i/o replaced
+    """
+    fragments = _Fragments()
+    for name in dir(x86_64):
+        if name.isupper() and isinstance(getattr(x86_64, name), str):
+            value = getattr(x86_64, name).replace('%rsp', TAPE_REGISTER)
+            setattr(fragments, name, value)
+    fragments.PROGRAM_START = PROGRAM_START
+    fragments.PROGRAM_END = PROGRAM_END
+    fragments.WRITE_CHAR = WRITE_CHAR
+    fragments.READ_CHAR = READ_CHAR
+    return fragments
+
+def _address(buf):
+    return ctypes.addressof(ctypes.c_char.from_buffer(buf))
+
+def compile_bf(s, offsets = True):
+    """
+    compile brainfuck source s into native code, returning a function
+
+        f(tape, input_bytes = b'', fill = None, output = None) -> (output, p)
+
+    with the same meaning as the functions returned by run.compile_bf:
+    the program runs on tape, a bytearray modified in place, starting
+    with the data pointer at 0. input is taken from input_bytes, then
+    from fill() -- if given -- which should return further bytes, or an
+    empty string at eof. output is appended to output, a bytearray,
+    which is returned along with the final data pointer.
+    raises ValueError if the brackets in s are unbalanced.
+    """
+    bf_ir.parse(s)
+    source = StringIO()
+    bootstrap_bf.compile_for_arch(jit_fragments(), s, offsets, source)
+    code, symbols = elf64.parse(source.getvalue()).text(0, 0)
+    region = mmap.mmap(-1, len(code),
+        prot = mmap.PROT_READ | mmap.PROT_WRITE | mmap.PROT_EXEC)
+    region.write(bytes(code))
+    bf_main = ctypes.CFUNCTYPE(ctypes.c_int64, ctypes.c_void_p,
+        ctypes.c_void_p)(_address(region) + symbols['_start'])
+
+    def run_compiled(tape, input_bytes = b'', fill = None, output = None):
+        if output is None:
+            output = bytearray()
+        pending = [bytes(input_bytes)]
+        inbuf = bytearray(IO_BUFFER_SIZE)
+        outbuf = bytearray(IO_BUFFER_SIZE)
+        errors = []
+        io = Io()
+
+        def flush_output(io_address):
+            output.extend(outbuf[:io.out_pos])
+            io.out_pos = 0
+
+        def fill_input(io_address):
+            # exceptions can't propagate out of the generated code, so
+            # they're kept until it returns, with the input at eof
+            io.in_len = 0
+            io.in_pos = 0
+            try:
+                if not pending[0] and fill is not None:
+                    flush_output(io_address)
+                    pending[0] = bytes(fill())
+            except Exception as e:
+                errors.append(e)
+                return
+            data = pending[0][:IO_BUFFER_SIZE]
+            pending[0] = pending[0][IO_BUFFER_SIZE:]
+            inbuf[:len(data)] = data
+            io.in_len = len(data)
+
+        io.inbuf = _address(inbuf)
+        io.outbuf = _address(outbuf)
+        io.out_len = IO_BUFFER_SIZE
+        # the callbacks must outlive the call
+        io.flush = flush_callback = FLUSH(flush_output)
+        io.fill = fill_callback = FILL(fill_input)
+        p = bf_main(_address(tape), ctypes.addressof(io))
+        flush_output(None)
+        if errors:
+            raise errors[0]
+        return output, p
+
+    # the code stays mapped as long as the function is around
+    run_compiled.region = region
+    return run_compiled
+
+def run_bf(s, input_bytes = b'', n_cells = DEFAULT_N_CELLS):
+    """
+    run brainfuck source s on input_bytes, returning the output bytes
+    """
+    output, _ = compile_bf(s)(bytearray(n_cells), input_bytes)
+    return bytes(output)
+
+def die(s):
+    sys.stderr.write(s + '\n')
+    sys.exit(1)
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(
+        description = 'run a brainfuck program as native x86_64 code')
+    p.add_argument('--cells', type = int, default = DEFAULT_N_CELLS,
+        help = 'size of the tape (default %(default)s)')
+    p.add_argument('input', help = 'brainfuck source file')
+    args = p.parse_args()
+
+    with open(args.input, 'r') as source_file:
+        s = source_file.read()
+
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    output = bytearray()
+
+    # write any pending output before blocking for more input
+    def fill():
+        stdout.write(output)
+        stdout.flush()
+        del output[:]
+        return os.read(sys.stdin.fileno(), 65536)
+
+    try:
+        f = compile_bf(s)
+    except ValueError as e:
+        die('error: %s' % e)
+    f(bytearray(args.cells), b'', fill, output)
+    stdout.write(output)
+    stdout.flush()
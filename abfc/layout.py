@@ -0,0 +1,130 @@
+"""
+chooses stack offsets for local allocations so that cells used
+together are placed near each other, cutting down on pointer moves
+
+takes the built-in calls recorded by compile_phase_2, as for
+liveness.py, along with the list of ('allocate', id) and ('free', id)
+events in the order they happened. allocations that are live at the
+same time must go in different cells.
+"""
+
+def _neighbour_weights(calls):
+    # the pointer visits the cells passed to each call roughly in
+    # order, so count how often each pair of cells is visited one
+    # after the other
+    weights = {}
+    previous = None
+    for (name, cells) in calls:
+        for cell in cells:
+            if cell is None:
+                continue
+            if previous is not None and previous != cell:
+                for (a, b) in ((previous, cell), (cell, previous)):
+                    weights.setdefault(a, {})
+                    weights[a][b] = weights[a].get(b, 0) + 1
+            previous = cell
+    return weights
+
+def _fixed_offset(cell):
+    # cells that are not allocations are stack address literals, which
+    # keep their offsets
+    if isinstance(cell, int):
+        return None
+    return cell[1]
+
+def choose_layout(calls, events):
+    """
+    returns a dict mapping allocation ids to stack offsets.
+
+    allocations are placed greedily, in the order they are made, at
+    the free offset minimising the weighted distance to the cells
+    already placed that they are used together with, then pairs of
+    allocations are swapped while that reduces the total distance.
+    this is a heuristic for the minimum linear arrangement problem.
+    """
+    weights = _neighbour_weights(calls)
+    layout = {}
+    # offsets of the allocations currently live
+    live = {}
+    for (event, x) in events:
+        if event == 'free':
+            del live[x]
+            continue
+        neighbours = []
+        for (y, w) in weights.get(x, {}).items():
+            if y in live:
+                neighbours.append((live[y], w))
+            elif _fixed_offset(y) is not None:
+                neighbours.append((_fixed_offset(y), w))
+        used = set(live.values())
+        best = None
+        # one past the end of the packed stack is always free
+        for offset in range(len(used) + 1):
+            if offset in used:
+                continue
+            cost = sum([w * abs(offset - o) for (o, w) in neighbours])
+            if best is None or cost < best[0]:
+                best = (cost, offset)
+        layout[x] = best[1]
+        live[x] = best[1]
+    _improve(layout, weights, _conflicts(events))
+    return layout
+
+def _conflicts(events):
+    # maps each allocation to the set of allocations live at the same
+    # time as it
+    conflicts = {}
+    live = set()
+    for (event, x) in events:
+        if event == 'free':
+            live.discard(x)
+            continue
+        conflicts[x] = set(live)
+        for y in live:
+            conflicts[y].add(x)
+        live.add(x)
+    return conflicts
+
+def _cost(layout, neighbours, offset):
+    cost = 0
+    for (y, w) in neighbours.items():
+        o = layout.get(y, _fixed_offset(y))
+        if o is not None:
+            cost += w * abs(offset - o)
+    return cost
+
+def _can_swap(layout, conflicts, x, y):
+    # x may take y's offset unless something else live alongside x
+    # already has it, and likewise for y
+    for (a, b) in ((x, y), (y, x)):
+        for z in conflicts[a]:
+            if z != b and layout[z] == layout[b]:
+                return False
+    return True
+
+def _improve(layout, weights, conflicts, max_rounds = 4):
+    # greedy placement can only look at the cells placed so far, and
+    # the stack is usually packed too tightly to move one allocation
+    # on its own, so swap the offsets of pairs of allocations while
+    # that brings their neighbours closer
+    ids = sorted(layout)
+    for i in range(max_rounds):
+        swapped = False
+        for x in ids:
+            for y in sorted(conflicts[x]):
+                if y < x:
+                    continue
+                (a, b) = (layout[x], layout[y])
+                if a == b:
+                    continue
+                before = (_cost(layout, weights.get(x, {}), a) +
+                    _cost(layout, weights.get(y, {}), b))
+                (layout[x], layout[y]) = (b, a)
+                after = (_cost(layout, weights.get(x, {}), b) +
+                    _cost(layout, weights.get(y, {}), a))
+                (layout[x], layout[y]) = (a, b)
+                if after < before and _can_swap(layout, conflicts, x, y):
+                    (layout[x], layout[y]) = (b, a)
+                    swapped = True
+        if not swapped:
+            break
@@ -0,0 +1,105 @@
+"""
+liveness analysis over the built-in calls made by a macro
+
+the calls are given as a list of (name, cells) pairs, in the order
+they are made, where cells holds a storage id for each argument: an
+int identifying a local allocation, None for constant arguments, or
+anything else for cells that are not allocated locals, such as stack
+address literals. those are treated as always live.
+
+begin_loop and end_loop calls are matched up to find the loops: from
+either end of a loop, control passes to the start of the body or past
+the end of the loop.
+"""
+
+import codegen
+
+# built-ins preserving their first argument via a temporary, and the
+# built-ins that do the same job destroying it instead
+DESTRUCTIVE_FORMS = {
+    'copy' : 'move',
+    'stack_add' : 'destructive_add',
+    'stack_sub' : 'destructive_sub',
+}
+
+# built-ins shifting the allocated cells into a new stack frame
+SHIFT_BUILT_INS = ('grow_stack', 'shrink_stack')
+
+def _successors(calls):
+    succ = [[i + 1] for i in range(len(calls))]
+    begins = []
+    for (i, (name, cells)) in enumerate(calls):
+        if name == 'begin_loop':
+            begins.append(i)
+        elif name == 'end_loop':
+            j = begins.pop()
+            succ[j] = [j + 1, i + 1]
+            succ[i] = [j + 1, i + 1]
+    assert not begins
+    return succ
+
+def _uses_and_kills(name, cells):
+    effects = codegen.ARGUMENT_EFFECTS.get(name, ('r', ) * len(cells))
+    uses = set()
+    kills = set()
+    for (effect, cell) in zip(effects, cells):
+        if cell is None or effect is None:
+            continue
+        if 'r' in effect:
+            uses.add(cell)
+        elif effect == 'w':
+            kills.add(cell)
+    return uses, kills - uses
+
+def live_out(calls):
+    """
+    returns, for each call, the set of cells that may be read after it
+    """
+    n = len(calls)
+    succ = _successors(calls)
+    effects = [_uses_and_kills(name, cells) for (name, cells) in calls]
+    live_in = [set() for i in range(n + 1)]
+    live_out = [set() for i in range(n)]
+    changed = True
+    while changed:
+        changed = False
+        for i in reversed(range(n)):
+            out = set()
+            for j in succ[i]:
+                out |= live_in[j]
+            uses, kills = effects[i]
+            new_in = uses | (out - kills)
+            live_out[i] = out
+            if new_in != live_in[i]:
+                live_in[i] = new_in
+                changed = True
+    return live_out
+
+def lower_last_uses(calls):
+    """
+    returns a dict mapping the numbers of calls that preserve a source
+    cell which is never read again to the destructive built-in to call
+    instead
+    """
+    lowered = {}
+    for (i, out) in enumerate(live_out(calls)):
+        name, cells = calls[i]
+        if name not in DESTRUCTIVE_FORMS:
+            continue
+        src, dst = cells
+        if isinstance(src, int) and src != dst and src not in out:
+            lowered[i] = DESTRUCTIVE_FORMS[name]
+    return lowered
+
+def live_across_shifts(calls):
+    """
+    returns a dict mapping the numbers of calls that shift the stack to
+    the set of local allocations that may be read after them. cells
+    not in the set hold dead values, so needn't be shifted
+    """
+    live = {}
+    for (i, out) in enumerate(live_out(calls)):
+        name, cells = calls[i]
+        if name in SHIFT_BUILT_INS:
+            live[i] = set([x for x in out if isinstance(x, int)])
+    return live
@@ -2,6 +2,8 @@
 limited structural pattern matching
 """
 
+from collections import OrderedDict
+
 # _match(p, e) convention:
 # if the match fails, return none
 # otherwise, return a list of (name, value) bindings, if any,
@@ -93,18 +95,149 @@ class Cons:
             return None
         return x + y
 
+# compiled patterns:
+# _compile(p) returns a function f(e, bindings) which, if e matches p,
+# appends the same (name, value) bindings _match(p, e) would return to
+# bindings and returns True, or otherwise returns False. tuples and
+# lists are indexed in place rather than being copied.
+
+def _as_sequence(e):
+    if isinstance(e, tuple) or isinstance(e, list):
+        return e
+    try:
+        return list(e)
+    except TypeError:
+        return None
+
+def _compile(p):
+    if isinstance(p, list) or isinstance(p, tuple):
+        return _compile_list(p)
+    elif isinstance(p, str):
+        return _compile_string(p)
+    elif isinstance(p, Star):
+        return _compile_star(p.name)
+    elif isinstance(p, One):
+        return lambda e, bindings : True
+    elif isinstance(p, Zero):
+        return lambda e, bindings : False
+    elif isinstance(p, Cons):
+        return _compile_cons(p)
+    else:
+        return _compile_obj(p)
+
+def _compile_string(p):
+    def match_string(e, bindings):
+        return p == e
+    return match_string
+
+def _compile_star(name):
+    def match_star(e, bindings):
+        bindings.append((name, e))
+        return True
+    return match_star
+
+def _compile_obj(p):
+    def match_obj(e, bindings):
+        z = p.matches(e)
+        if z is None:
+            return False
+        bindings.extend(z)
+        return True
+    return match_obj
+
+def _compile_list(p):
+    n = len(p)
+    # check string literals (usually tags) first, as they are cheap and
+    # bind nothing. the other items are matched in order, so bindings
+    # come out in the same order as from _match
+    literals = [(i, x) for (i, x) in enumerate(p) if isinstance(x, str)]
+    others = [(i, _compile(x)) for (i, x) in enumerate(p) if not isinstance(x, str)]
+    def match_list(e, bindings):
+        e = _as_sequence(e)
+        if e is None or len(e) != n:
+            return False
+        for (i, x) in literals:
+            if e[i] != x:
+                return False
+        for (i, f) in others:
+            if not f(e[i], bindings):
+                return False
+        return True
+    return match_list
+
+def _compile_cons(p):
+    # a chain of Cons patterns matches its heads against the leading
+    # items of e in place, and only the remainder is copied into a list
+    # for the tail pattern
+    heads = []
+    while isinstance(p, Cons):
+        heads.append(_compile(p.head_pattern))
+        p = p.tail_pattern
+    k = len(heads)
+    if isinstance(p, One):
+        tail = None
+    else:
+        tail = _compile(p)
+    def match_cons(e, bindings):
+        e = _as_sequence(e)
+        if e is None or len(e) < k:
+            return False
+        for i in range(k):
+            if not heads[i](e[i], bindings):
+                return False
+        if tail is None:
+            return True
+        return tail(list(e[k:]), bindings)
+    return match_cons
+
+def _pattern_key(p):
+    # structural key used to share compiled patterns. list and tuple
+    # patterns match alike, so they share keys too
+    if isinstance(p, list) or isinstance(p, tuple):
+        return ('seq', ) + tuple([_pattern_key(x) for x in p])
+    elif isinstance(p, str):
+        return p
+    elif isinstance(p, Star):
+        return ('star', p.name)
+    elif isinstance(p, One):
+        return ('one', )
+    elif isinstance(p, Zero):
+        return ('zero', )
+    elif isinstance(p, Cons):
+        return ('cons', _pattern_key(p.head_pattern), _pattern_key(p.tail_pattern))
+    else:
+        # the compiled pattern keeps p alive, so its id stays unique
+        return ('obj', id(p))
+
+# compiled patterns, least recently used first. patterns may be built
+# on the fly, with constants in them, so only the most recently used
+# are kept
+MAX_COMPILED_PATTERNS = 256
+_COMPILED_PATTERNS = OrderedDict()
+
+def compile_pattern(p):
+    key = _pattern_key(p)
+    compiled = _COMPILED_PATTERNS.pop(key, None)
+    if compiled is None:
+        compiled = _compile(p)
+        if len(_COMPILED_PATTERNS) >= MAX_COMPILED_PATTERNS:
+            _COMPILED_PATTERNS.popitem(last = False)
+    _COMPILED_PATTERNS[key] = compiled
+    return compiled
+
 class Matcher:
     def __init__(self, pattern):
         self.pattern = pattern
+        self._matches = compile_pattern(pattern)
 
     def replace(self, action):
         return MatchReplaceRule(self, action)
 
     def attempt_match(self, expression):
-        m = _match(self.pattern, expression)
-        if m is not None:
-            m = dict(m)
-        return m
+        bindings = []
+        if self._matches(expression, bindings):
+            return dict(bindings)
+        return None
 
 class MatchReplaceRule:
     def __init__(self, matcher, action):
@@ -8,9 +8,10 @@ def DEF_MACRO(name, *params):
         _USER_MACROS[name] = macro
     return _capture_macro_body
 
-def test_compile():
+def test_compile(source_map = None, n_cells = 30000):
     import expr
     main_macro = expr.compile_macro(_USER_MACROS, 'main')
     import compile
     import codegen
-    compile.compile_phase_2(codegen._BUILT_IN_MACROS, main_macro)
+    compile.compile_phase_2(codegen._BUILT_IN_MACROS, main_macro,
+        source_map = source_map, n_cells = n_cells)
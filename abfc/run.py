@@ -0,0 +1,483 @@
+"""
+runs brainfuck programs in-process, without an assembler
+
+the program is parsed and optimised with bf_ir, then translated into
+the source of a python function operating on a bytearray tape, which
+is compiled once and executed. if numpy is installed, --engine numpy
+also views the tape as a numpy array for bulk scans and clears.
+
+run with no arguments to see usage. the program reads from stdin and
+writes to stdout.
+"""
+
+import os
+import sys
+import argparse
+import itertools
+import bf_ir
+import bf_profile
+
+# numpy is optional, and only needed for the numpy engine
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_N_CELLS = 30000
+
+# python refuses to compile more than 20 statically nested blocks, so
+# loops nested deeper than this are compiled into functions of their
+# own
+MAX_NESTED_LOOPS = 16
+
+def _is_balanced(ops):
+    # True if running ops always leaves the data pointer where it was
+    if [op for op in ops if op[0] == 'scan']:
+        return False
+    if sum([op[1] for op in ops if op[0] == 'move']) != 0:
+        return False
+    return all([_is_balanced(op[1]) for op in ops if op[0] == 'loop'])
+
+def _counted(ops):
+    # prefix each list of ops with a count op adding its length to the
+    # count of ops executed. a loop counts once each time it is reached,
+    # and its body once per iteration
+    counted = [('count', len(ops))]
+    for op in ops:
+        if op[0] == 'loop':
+            counted.append(('loop', _counted(op[1])))
+        else:
+            counted.append(op)
+    return counted
+
+def _profiled(ops, numbers):
+    # prefix each list of ops with a profile op counting the times it
+    # runs. lists are numbered from numbers in the order they start
+    profiled = [('profile', next(numbers))]
+    for op in ops:
+        if op[0] == 'loop':
+            profiled.append(('loop', _profiled(op[1], numbers)))
+        else:
+            profiled.append(op)
+    return profiled
+
+def _linear_add(a, b, factor):
+    # a + factor * b, for linear combinations of cells stored as
+    # {offset : coefficient} dicts, with the constant term at None.
+    # all arithmetic is mod 256.
+    result = dict(a)
+    for key in b:
+        c = (result.get(key, 0) + factor * b[key]) % 256
+        if c:
+            result[key] = c
+        else:
+            result.pop(key, None)
+    return result
+
+class PythonCodeGenerator:
+    """
+    translates a list of bf_ir ops into python source.
+
+    the generated code keeps the machine state in local variables:
+
+        t           the tape, a bytearray
+        p           the data pointer
+        inp, ip     the current block of input, and offset into it
+        fill        returns the next block of input, empty at eof
+        out_append  appends a byte to the output
+
+    within straight-line code, adds, clears and muls are evaluated
+    symbolically: each cell's value is tracked as a linear combination
+    of the values the cells had at the start of the block, and only
+    the cells that end up changed are written back, once, before the
+    next loop, scan, move or read.
+    """
+
+    STATE = 't, p, inp, ip, fill, out_append'
+
+    def __init__(self):
+        self.functions = []
+        self.n_functions = 0
+        # values of cells changed since the last write back
+        self.values = {}
+        # cells known to hold zero as of the last write back
+        self.known_zero = set()
+
+    def address(self, offset):
+        if offset == 0:
+            return 'p'
+        elif offset > 0:
+            return 'p + %d' % offset
+        else:
+            return 'p - %d' % (-offset)
+
+    def cell(self, offset):
+        return 't[%s]' % self.address(offset)
+
+    def value(self, offset):
+        if offset in self.values:
+            return self.values[offset]
+        elif offset in self.known_zero:
+            return {}
+        else:
+            return {offset : 1}
+
+    def expression(self, value, loaded = {}):
+        """
+        python expression computing value, reading cells from the
+        variables in loaded where present
+        """
+        terms = []
+        for key in sorted(value, key = str):
+            c = value[key]
+            if c > 128:
+                c -= 256
+            if key is None:
+                terms.append('%d' % c)
+                continue
+            x = loaded.get(key, self.cell(key))
+            if c == 1:
+                terms.append(x)
+            elif c == -1:
+                terms.append('-' + x)
+            else:
+                terms.append('%d * %s' % (c, x))
+        if not terms:
+            return '0'
+        elif len(terms) == 1 and None not in value and value[key] == 1:
+            return terms[0]
+        elif len(terms) == 1 and key is None:
+            return '%d' % value[None]
+        else:
+            return '(%s) & 255' % ' + '.join(terms).replace('+ -', '- ')
+
+    def write_back(self, lines, indent):
+        changed = [k for k in sorted(self.values)
+            if self.values[k] != ({} if k in self.known_zero else {k : 1})]
+        # cells read by the new values but overwritten first need to
+        # be loaded before anything is stored
+        loaded = {}
+        for k in changed:
+            for j in self.values[k]:
+                if j in changed and j != k and j not in loaded:
+                    loaded[j] = 'x%d' % len(loaded)
+                    lines.append('%s%s = %s' % (indent, loaded[j], self.cell(j)))
+        self.gen_zero(lines, indent, [k for k in changed if not self.values[k]])
+        for k in changed:
+            if self.values[k]:
+                lines.append('%s%s = %s' % (indent, self.cell(k),
+                    self.expression(self.values[k], loaded)))
+        self.known_zero = set([k for k in set(self.values) | self.known_zero
+            if not self.value(k)])
+        self.values = {}
+
+    def gen_zero(self, lines, indent, offsets):
+        for k in offsets:
+            lines.append('%s%s = 0' % (indent, self.cell(k)))
+
+    def gen_add(self, lines, indent, n, offset):
+        self.values[offset] = _linear_add(self.value(offset), {None : n}, 1)
+
+    def gen_clear(self, lines, indent, offset):
+        self.values[offset] = {}
+
+    def gen_mul(self, lines, indent, base, terms):
+        x = self.value(base)
+        for (k, factor) in terms:
+            self.values[base + k] = _linear_add(self.value(base + k), x, factor)
+        self.values[base] = {}
+
+    def gen_move(self, lines, indent, n):
+        self.write_back(lines, indent)
+        lines.append('%sp += %d' % (indent, n))
+        self.known_zero = set([k - n for k in self.known_zero])
+
+    def gen_scan(self, lines, indent, stride):
+        self.write_back(lines, indent)
+        # single steps can use the bytearray's own search
+        if stride == 1:
+            lines.append("%sp = t.index(b'\\x00', p)" % indent)
+        elif stride == -1:
+            lines.append("%sp = t.rindex(b'\\x00', 0, p + 1)" % indent)
+        else:
+            lines.append('%swhile t[p]:' % indent)
+            lines.append('%s    p += %d' % (indent, stride))
+        self.known_zero = set([0])
+
+    def gen_read(self, lines, indent):
+        # n.b. at eof the cell is left unchanged
+        self.write_back(lines, indent)
+        lines.append('%sif ip >= len(inp):' % indent)
+        lines.append('%s    inp, ip = bytearray(fill()), 0' % indent)
+        lines.append('%sif ip < len(inp):' % indent)
+        lines.append('%s    t[p] = inp[ip]' % indent)
+        lines.append('%s    ip += 1' % indent)
+        self.known_zero.discard(0)
+
+    def gen_count(self, lines, indent, n):
+        lines.append('%scounts[0] += %d' % (indent, n))
+
+    def gen_profile(self, lines, indent, k):
+        lines.append('%sprofile[%d] += 1' % (indent, k))
+
+    def gen_write(self, lines, indent):
+        lines.append('%sout_append(%s)' % (indent, self.expression(self.value(0))))
+
+    def gen_loop(self, lines, indent, body, depth):
+        self.write_back(lines, indent)
+        if depth >= MAX_NESTED_LOOPS:
+            name = self.gen_function([('loop', body)])
+            lines.append('%sp, inp, ip = %s(%s)' % (indent, name, self.STATE))
+        else:
+            # a loop that leaves the pointer where it found it, with the
+            # current cell cleared, runs at most once
+            body_lines = []
+            self.known_zero = set()
+            self.gen_ops(body_lines, indent + '    ', body, depth + 1)
+            self.write_back(body_lines, indent + '    ')
+            if _is_balanced(body) and 0 in self.known_zero:
+                lines.append('%sif t[p]:' % indent)
+            else:
+                lines.append('%swhile t[p]:' % indent)
+            if not body_lines:
+                body_lines.append('%s    pass' % indent)
+            lines.extend(body_lines)
+        self.known_zero = set([0])
+
+    def gen_ops(self, lines, indent, ops, depth):
+        for op in ops:
+            kind = op[0]
+            if kind == 'loop':
+                self.gen_loop(lines, indent, op[1], depth)
+            else:
+                getattr(self, 'gen_' + kind)(lines, indent, *op[1:])
+
+    def gen_function(self, ops):
+        """
+        generate a function running ops, returning its name. the
+        function takes the machine state as arguments and returns the
+        updated p, inp, ip
+        """
+        name = 'bf_%d' % self.n_functions
+        self.n_functions += 1
+        lines = ['def %s(%s):' % (name, self.STATE)]
+        self.values = {}
+        self.known_zero = set()
+        self.gen_ops(lines, '    ', ops, 0)
+        self.write_back(lines, '    ')
+        lines.append('    return p, inp, ip')
+        self.functions.append('\n'.join(lines) + '\n')
+        return name
+
+    def gen_program(self, ops):
+        """
+        returns python source defining the functions for the program,
+        along with the name of the entry point
+        """
+        name = self.gen_function(ops)
+        return '\n'.join(self.functions), name
+
+    def namespace(self):
+        """
+        globals for the generated code
+        """
+        return {}
+
+def _numpy_scan(a, p, stride):
+    # find the first zero cell out of a[p], a[p + stride], ... looking
+    # through windows of the tape that double in size each time, so
+    # short scans don't pay for comparing the whole tape
+    n = 64
+    while 0 <= p < len(a):
+        cells = a[p::stride][:n]
+        i = int(np.argmax(cells == 0))
+        if cells[i] == 0:
+            return p + i * stride
+        p += n * stride
+        n *= 2
+    raise IndexError('scan ran off the end of the tape')
+
+class NumpyCodeGenerator(PythonCodeGenerator):
+    """
+    as PythonCodeGenerator, but also views the tape as a numpy uint8
+    array, a. scans with strides other than +/-1 (which bytearray
+    already searches for with memchr) are done by _numpy_scan, and runs
+    of cells cleared together in straight-line code, as left behind by
+    codegen's grow_stack and shrink_stack, become slice assignments.
+    """
+
+    STATE = 't, a, p, inp, ip, fill, out_append'
+
+    # shorter runs of clears are cheaper as separate stores
+    MIN_CLEAR_RUN = 4
+
+    def gen_zero(self, lines, indent, offsets):
+        runs = []
+        for k in offsets:
+            if runs and runs[-1][-1] == k - 1:
+                runs[-1].append(k)
+            else:
+                runs.append([k])
+        for run in runs:
+            if len(run) < self.MIN_CLEAR_RUN:
+                PythonCodeGenerator.gen_zero(self, lines, indent, run)
+            else:
+                lines.append('%sa[%s:%s] = 0' % (indent,
+                    self.address(run[0]), self.address(run[-1] + 1)))
+
+    def gen_scan(self, lines, indent, stride):
+        if stride in (1, -1):
+            PythonCodeGenerator.gen_scan(self, lines, indent, stride)
+            return
+        self.write_back(lines, indent)
+        lines.append('%sp = scan(a, p, %d)' % (indent, stride))
+        self.known_zero = set([0])
+
+    def gen_program(self, ops):
+        source, name = PythonCodeGenerator.gen_program(self, ops)
+        # the entry point takes the same arguments as the plain python
+        # engine's, so set up the numpy view of the tape here
+        source += '\n'.join([
+            '',
+            'def bf_main(t, p, inp, ip, fill, out_append):',
+            '    a = np.frombuffer(t, dtype = np.uint8)',
+            '    return %s(%s)' % (name, self.STATE),
+            '',
+        ])
+        return source, 'bf_main'
+
+    def namespace(self):
+        return {'np' : np, 'scan' : _numpy_scan}
+
+ENGINES = {
+    'python' : PythonCodeGenerator,
+}
+
+if np is not None:
+    ENGINES['numpy'] = NumpyCodeGenerator
+
+def compile_bf(s, engine = 'python', counts = None, profile = None):
+    """
+    compile brainfuck source s into a python function
+
+        f(tape, input_bytes = b'', fill = None, output = None) -> (output, p)
+
+    which runs the program on tape, a bytearray modified in place,
+    starting with the data pointer at 0. input is taken from
+    input_bytes, then from fill() -- if given -- which should return
+    further bytes, or an empty string at eof. output is appended to
+    output, a bytearray, which is returned along with the final data
+    pointer.
+    if counts is given, a list, the number of bf_ir ops executed is
+    added to counts[0] as the program runs.
+    if profile is given, an empty list, it is filled with the number
+    of times each list of ops runs: first the program itself, then the
+    body of each loop, in the order the loops start in s. see
+    bf_profile for turning these into counts per opcode.
+    raises ValueError if the brackets in s are unbalanced.
+    """
+    program = bf_ir.offset_ops(bf_ir.optimize_loops(bf_ir.parse(s)))
+    if counts is not None:
+        program = _counted(program)
+    if profile is not None:
+        numbers = itertools.count()
+        program = _profiled(program, numbers)
+        profile.extend([0] * next(numbers))
+    code_generator = ENGINES[engine]()
+    source, entry_point = code_generator.gen_program(program)
+    namespace = code_generator.namespace()
+    namespace['counts'] = counts
+    namespace['profile'] = profile
+    exec(compile(source, '<brainfuck>', 'exec'), namespace, namespace)
+    bf_main = namespace[entry_point]
+
+    def run_compiled(tape, input_bytes = b'', fill = None, output = None):
+        if fill is None:
+            fill = bytes
+        if output is None:
+            output = bytearray()
+        p, _, _ = bf_main(tape, 0, bytearray(input_bytes), 0, fill,
+            output.append)
+        return output, p
+    return run_compiled
+
+def run_bf(s, input_bytes = b'', n_cells = DEFAULT_N_CELLS, engine = 'python'):
+    """
+    run brainfuck source s on input_bytes, returning the output bytes
+    """
+    output, _ = compile_bf(s, engine)(bytearray(n_cells), input_bytes)
+    return bytes(output)
+
+def count_bf(s, input_bytes = b'', n_cells = DEFAULT_N_CELLS, engine = 'python'):
+    """
+    run brainfuck source s on input_bytes, returning the output bytes
+    and the number of bf_ir ops executed
+    """
+    counts = [0]
+    output, _ = compile_bf(s, engine, counts)(bytearray(n_cells), input_bytes)
+    return bytes(output), counts[0]
+
+def profile_bf(s, input_bytes = b'', n_cells = DEFAULT_N_CELLS, engine = 'python'):
+    """
+    run brainfuck source s on input_bytes, returning the output bytes
+    and a bf_profile.Profile of the run
+    """
+    list_counts = []
+    f = compile_bf(s, engine, profile = list_counts)
+    output, _ = f(bytearray(n_cells), input_bytes)
+    return bytes(output), bf_profile.Profile(s, list_counts)
+
+def die(s):
+    sys.stderr.write(s + '\n')
+    sys.exit(1)
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description = 'run a brainfuck program')
+    p.add_argument('--engine', choices = sorted(ENGINES), default = 'python')
+    p.add_argument('--cells', type = int, default = DEFAULT_N_CELLS,
+        help = 'size of the tape (default %(default)s)')
+    p.add_argument('--count', action = 'store_true',
+        help = 'print the number of ops executed to stderr')
+    p.add_argument('--profile', metavar = 'FILE',
+        help = 'write the steps executed as folded stacks to FILE, and '
+            'print a report of where they went to stderr')
+    p.add_argument('--source-map', metavar = 'FILE',
+        help = 'with --profile, attribute steps to the macro stacks in '
+            'FILE, as written by compile_macro.py --source-map')
+    p.add_argument('input', help = 'brainfuck source file')
+    args = p.parse_args()
+
+    with open(args.input, 'r') as source_file:
+        s = source_file.read()
+
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    output = bytearray()
+
+    # write any pending output before blocking for more input
+    def fill():
+        stdout.write(output)
+        stdout.flush()
+        del output[:]
+        return os.read(sys.stdin.fileno(), 65536)
+
+    counts = [0] if args.count else None
+    list_counts = [] if args.profile else None
+    try:
+        f = compile_bf(s, args.engine, counts, list_counts)
+    except ValueError as e:
+        die('error: %s' % e)
+    f(bytearray(args.cells), b'', fill, output)
+    stdout.write(output)
+    stdout.flush()
+    if counts is not None:
+        sys.stderr.write('ops executed: %d\n' % counts[0])
+    if list_counts is not None:
+        profile = bf_profile.Profile(s, list_counts)
+        if args.source_map:
+            with open(args.source_map, 'r') as map_file:
+                stacks = profile.fold(bf_profile.read_source_map(map_file))
+        else:
+            stacks = profile.fold_loops()
+        with open(args.profile, 'w') as folded_file:
+            bf_profile.write_folded(stacks, folded_file)
+        bf_profile.write_report(stacks, sys.stderr)
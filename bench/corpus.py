@@ -0,0 +1,101 @@
+"""
+generates the brainfuck programs used as workloads by the benchmarks
+
+each workload is a (name, source, input) triple. the programs are
+built from a fixed seed, so the corpus is the same on every run and
+under both python 2 and python 3.
+"""
+
+class Lcg:
+    """
+    a small linear congruential generator. python's own random module
+    doesn't promise the same sequence across versions.
+    """
+    def __init__(self, seed):
+        self.state = seed
+
+    def next(self, n):
+        # returns an int in range(n)
+        self.state = (self.state * 1103515245 + 12345) % (2 ** 31)
+        return (self.state >> 8) % n
+
+TEXT = (
+    'the quick brown fox jumps over the lazy dog. '
+    'pack my box with five dozen liquor jugs! '
+    'how vexingly quick daft zebras jump?\n'
+)
+
+def print_string(s):
+    # prints s from a single cell, stepping it from each character to
+    # the next
+    code = []
+    current = 0
+    for c in s:
+        delta = (ord(c) - current) % 256
+        if delta <= 128:
+            code.append('+' * delta)
+        else:
+            code.append('-' * (256 - delta))
+        code.append('.')
+        current = ord(c)
+    return ''.join(code)
+
+def text_printer(n_repeats):
+    # long runs of + and -
+    return print_string(TEXT * n_repeats)
+
+def nested_loops(depth, count):
+    # counts to count ** depth in nested loops, one cell per level,
+    # printing the accumulated total, mod 256, after each innermost
+    # loop finishes
+    code = []
+    for i in range(depth):
+        code.append('+' * count + '[>')
+    code.append('+' * count + '[>+<-]>.<')
+    for i in range(depth):
+        code.append('<-]')
+    return ''.join(code)
+
+def cat():
+    # echoes its input, up to a zero byte. the programs leave the cell
+    # unchanged at eof, so the input needs the terminator
+    return ',[.,]'
+
+def random_arithmetic(seed, n_ops, width):
+    # straight-line arithmetic over width cells, with multiply and
+    # clear loops, which always terminate
+    rng = Lcg(seed)
+    code = []
+    p = 0
+    for i in range(n_ops):
+        kind = rng.next(6)
+        if kind == 0:
+            code.append('+' * (1 + rng.next(20)))
+        elif kind == 1:
+            code.append('-' * (1 + rng.next(20)))
+        elif kind == 2:
+            q = rng.next(width)
+            code.append('>' * (q - p) if q > p else '<' * (p - q))
+            p = q
+        elif kind == 3:
+            q = rng.next(width)
+            if q != p:
+                there = '>' * (q - p) if q > p else '<' * (p - q)
+                back = '<' * (q - p) if q > p else '>' * (p - q)
+                code.append('[-' + there + '+' * (1 + rng.next(4)) + back + ']')
+        elif kind == 4:
+            code.append('[-]')
+        else:
+            code.append('.')
+    return ''.join(code)
+
+def workloads():
+    """
+    returns the list of (name, source, input) workloads
+    """
+    return [
+        ('text_printer', text_printer(4), b''),
+        ('nested_loops', nested_loops(6, 8), b''),
+        ('cat', cat(), (TEXT * 64).encode('ascii') + b'\x00'),
+        ('random_arithmetic', random_arithmetic(1, 1000, 16), b''),
+    ]
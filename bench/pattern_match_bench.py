@@ -0,0 +1,104 @@
+"""
+compares the compiled pattern matchers against the original recursive
+_match, by timing compile_macro on the self-hosting compiler's macros,
+and by replaying just the match attempts it makes. matching is only
+part of compile_macro, so the speedup of the whole is the smaller.
+
+usage: python bench/pattern_match_bench.py [repeats]
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'abfc'))
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import pattern_match as pm
+from arch import load_arch
+from compile_macro import compile_macro_for_arch
+
+MACRO_FILE = os.path.join(ROOT, 'macros', 'self_hosting_bf_compiler.py')
+
+def interpreted_attempt_match(self, expression):
+    m = pm._match(self.pattern, expression)
+    if m is not None:
+        m = dict(m)
+    return m
+
+def time_compile(macro_code, repeats):
+    # returns the best time out of repeats, along with the output
+    best = None
+    for i in range(repeats):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            t0 = time.time()
+            compile_macro_for_arch(load_arch('--x86-64'), macro_code)
+            t = time.time() - t0
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        if best is None or t < best:
+            best = t
+    return best, output
+
+def record_matches(macro_code):
+    # returns the (matcher, expression) pairs attempted by compile_macro
+    calls = []
+    compiled_attempt_match = pm.Matcher.attempt_match
+    def recording_attempt_match(self, expression):
+        calls.append((self, expression))
+        return compiled_attempt_match(self, expression)
+    pm.Matcher.attempt_match = recording_attempt_match
+    try:
+        time_compile(macro_code, 1)
+    finally:
+        pm.Matcher.attempt_match = compiled_attempt_match
+    return calls
+
+def time_matches(calls, attempt_match, repeats):
+    best = None
+    for i in range(repeats):
+        t0 = time.time()
+        for (matcher, expression) in calls:
+            attempt_match(matcher, expression)
+        t = time.time() - t0
+        if best is None or t < best:
+            best = t
+    return best
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    with open(MACRO_FILE, 'r') as source_file:
+        macro_code = '\n'.join(source_file.readlines())
+
+    t_compiled, output_compiled = time_compile(macro_code, repeats)
+    compiled_attempt_match = pm.Matcher.attempt_match
+    pm.Matcher.attempt_match = interpreted_attempt_match
+    try:
+        t_interpreted, output_interpreted = time_compile(macro_code, repeats)
+    finally:
+        pm.Matcher.attempt_match = compiled_attempt_match
+
+    assert output_compiled == output_interpreted
+    print('compile_macro')
+    print('  interpreted _match : %.3fs' % t_interpreted)
+    print('  compiled matchers  : %.3fs' % t_compiled)
+    print('  speedup            : %.2fx' % (t_interpreted / t_compiled))
+
+    calls = record_matches(macro_code)
+    t_compiled = time_matches(calls, pm.Matcher.attempt_match, repeats)
+    t_interpreted = time_matches(calls, interpreted_attempt_match, repeats)
+    print('%d match attempts' % len(calls))
+    print('  interpreted _match : %.3fs' % t_interpreted)
+    print('  compiled matchers  : %.3fs' % t_compiled)
+    print('  speedup            : %.2fx' % (t_interpreted / t_compiled))
+
+if __name__ == '__main__':
+    main()
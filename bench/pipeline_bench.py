@@ -0,0 +1,302 @@
+"""
+times each stage of the build pipeline for each arch, then uses the
+compilers it built on the workloads from corpus.py, writing the
+results as json
+
+for each arch, the stages are:
+
+    compile_macro       macro source -> brainfuck, also timed in-process
+                        as phase 1 rewriting, inlining and phase 2
+                        emission
+    bootstrap_bf        brainfuck -> boot compiler assembly
+    boot                boot compiler compiling the brainfuck
+    self_hosted         self-hosted compiler compiling the brainfuck,
+                        which should reach the fixed point
+
+and for each workload, the self-hosted compiler compiling it, and the
+resulting program running on the workload's input. ops executed are
+counted by running the brainfuck under run.py.
+
+stages run as subprocesses. times are the best out of --repeats runs,
+in seconds: wall time, and cpu time from os.wait4. peak rss is the
+largest VmHWM seen in /proc while the stage runs, in kilobytes, or
+null if the stage finished before it could be sampled. the ru_maxrss
+from os.wait4 can't be used, as a forked child inherits the rss of
+this process.
+
+usage: python bench/pipeline_bench.py [--x86-64] [--ia32] [--output FILE]
+
+benchmarks --x86-64 and --ia32 if no arch is given.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ABFC = os.path.join(ROOT, 'abfc')
+sys.path.insert(0, ABFC)
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import corpus
+import run
+import expr
+import compile
+from arch import KNOWN_ARCHS, load_arch
+from compile_macro import compile_macro_for_arch
+
+MACRO_FILE = os.path.join(ROOT, 'macros', 'self_hosting_bf_compiler.py')
+
+DEFAULT_ARCHS = ['--x86-64', '--ia32']
+
+CC = 'gcc'
+CC_OPTS = ['-nostdlib', '-Wl,--build-id=none']
+# linked as static pies, as the 64-bit archs are by default, so no
+# 32-bit dynamic loader is needed
+ARCH_CC_OPTS = {
+    '--ia32' : ['-m32', '-static-pie'],
+    '--ia32-buffered' : ['-m32', '-static-pie'],
+}
+# archs generating c, which is compiled with the c library
+C_ARCHS = {
+    '--c' : ['-O2', '-x', 'c'],
+}
+
+BF_OPCODES = '+-<>[].,'
+
+def die(s):
+    sys.stderr.write(s + '\n')
+    sys.exit(1)
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def write_bytes(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def count_opcodes(s):
+    return len([c for c in s if c in BF_OPCODES])
+
+# seconds between samples of a running stage's peak rss
+RSS_SAMPLE_INTERVAL = 0.001
+
+def peak_rss(pid):
+    # VmHWM of a running process, in kilobytes, or None if it has gone
+    try:
+        with open('/proc/%d/status' % pid, 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+def max_rss(a, b):
+    # either may be None, if not known
+    if a is None or b is None:
+        return a if b is None else b
+    return max(a, b)
+
+def run_stage(args, stdin_path, stdout_path):
+    """
+    runs args as a subprocess, reading stdin_path and writing
+    stdout_path, returning the wall time, cpu time and peak rss
+    """
+    with open(stdin_path, 'rb') as stdin:
+        with open(stdout_path, 'wb') as stdout:
+            t0 = time.time()
+            # Popen returns once the program has been exec'd, so the
+            # samples are never of the rss inherited from this process
+            p = subprocess.Popen(args, stdin = stdin, stdout = stdout)
+            rss = None
+            while True:
+                pid, status, rusage = os.wait4(p.pid, os.WNOHANG)
+                if pid != 0:
+                    break
+                rss = max_rss(rss, peak_rss(p.pid))
+                time.sleep(RSS_SAMPLE_INTERVAL)
+            t = time.time() - t0
+    # wait4 reaped the process, so Popen mustn't try to
+    p.returncode = status
+    if status != 0:
+        die('error: %s exited with status %d' % (' '.join(args), status))
+    return t, rusage.ru_utime + rusage.ru_stime, rss
+
+def time_stage(args, stdin_path, stdout_path, repeats):
+    times = []
+    cpu_times = []
+    rss = None
+    for i in range(repeats):
+        t, cpu_time, r = run_stage(args, stdin_path, stdout_path)
+        times.append(t)
+        cpu_times.append(cpu_time)
+        rss = max_rss(rss, r)
+    return {'time' : min(times), 'cpu_time' : min(cpu_times),
+        'peak_rss_kb' : rss}
+
+class PhaseTimer:
+    """
+    wraps a module-level function, adding up the time spent in it
+    """
+    def __init__(self, module, name):
+        self.module = module
+        self.name = name
+        self.f = getattr(module, name)
+        self.total = 0.0
+
+    def __enter__(self):
+        def timed(*args, **kwargs):
+            t0 = time.time()
+            try:
+                return self.f(*args, **kwargs)
+            finally:
+                self.total += time.time() - t0
+        setattr(self.module, self.name, timed)
+        return self
+
+    def __exit__(self, *exc_info):
+        setattr(self.module, self.name, self.f)
+
+def time_compile_macro_phases(arch_name, macro_code, repeats):
+    best = None
+    for i in range(repeats):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            with PhaseTimer(expr, 'rewrite_macro_until_fixed_point') as rewrite:
+                with PhaseTimer(expr, 'expand_all_macro_calls') as inline:
+                    with PhaseTimer(compile, 'compile_phase_2') as emit:
+                        compile_macro_for_arch(load_arch(arch_name), macro_code)
+        finally:
+            sys.stdout = stdout
+        phases = {
+            'rewrite' : rewrite.total,
+            'inline' : inline.total,
+            'emit' : emit.total,
+        }
+        if best is None:
+            best = phases
+        else:
+            for key in phases:
+                best[key] = min(best[key], phases[key])
+    return best
+
+def assemble(arch_name, asm_path, out_path):
+    if arch_name in C_ARCHS:
+        args = [CC] + C_ARCHS[arch_name] + [asm_path]
+    else:
+        args = [CC, asm_path] + CC_OPTS + ARCH_CC_OPTS.get(arch_name, [])
+    if subprocess.call(args + ['-o', out_path]) != 0:
+        die('error: could not assemble %s' % asm_path)
+
+def bench_arch(arch_name, work_dir, repeats):
+    def path(name):
+        return os.path.join(work_dir, name)
+
+    with open(MACRO_FILE, 'r') as source_file:
+        macro_code = '\n'.join(source_file.readlines())
+
+    stages = {}
+    stages['compile_macro'] = time_stage(
+        [sys.executable, os.path.join(ABFC, 'compile_macro.py'), arch_name,
+            MACRO_FILE],
+        os.devnull, path('bf_compiler.brainfuck'), repeats)
+    stages['compile_macro']['phases'] = time_compile_macro_phases(arch_name,
+        macro_code, repeats)
+    stages['bootstrap_bf'] = time_stage(
+        [sys.executable, os.path.join(ABFC, 'bootstrap_bf.py'), arch_name,
+            path('bf_compiler.brainfuck')],
+        os.devnull, path('bf_compiler_boot.s'), repeats)
+    assemble(arch_name, path('bf_compiler_boot.s'), path('bf_compiler_boot.out'))
+    stages['boot'] = time_stage([path('bf_compiler_boot.out')],
+        path('bf_compiler.brainfuck'), path('bf_compiler_self_hosted.s'),
+        repeats)
+    assemble(arch_name, path('bf_compiler_self_hosted.s'),
+        path('bf_compiler_self_hosted.out'))
+    stages['self_hosted'] = time_stage([path('bf_compiler_self_hosted.out')],
+        path('bf_compiler.brainfuck'), path('bf_compiler_self_hosted_2.s'),
+        repeats)
+    if (read_bytes(path('bf_compiler_self_hosted.s')) !=
+            read_bytes(path('bf_compiler_self_hosted_2.s'))):
+        die('error: %s self-hosted compiler did not reach a fixed point' %
+            arch_name)
+
+    compiler_bf = read_bytes(path('bf_compiler.brainfuck')).decode('ascii')
+    sizes = {
+        'bf_bytes' : len(compiler_bf),
+        'bf_opcodes' : count_opcodes(compiler_bf),
+        'boot_asm_bytes' : len(read_bytes(path('bf_compiler_boot.s'))),
+        'self_hosted_asm_bytes' :
+            len(read_bytes(path('bf_compiler_self_hosted.s'))),
+    }
+
+    workloads = {}
+    for (name, source, input_bytes) in corpus.workloads():
+        write_bytes(path(name + '.brainfuck'), source.encode('ascii'))
+        write_bytes(path(name + '.in'), input_bytes)
+        result = {'bf_opcodes' : count_opcodes(source)}
+        result['compile'] = time_stage([path('bf_compiler_self_hosted.out')],
+            path(name + '.brainfuck'), path(name + '.s'), repeats)
+        asm = read_bytes(path(name + '.s'))
+        result['asm_bytes'] = len(asm)
+        # the compiler, run on the workload, should give the same asm
+        compiler_output, result['compiler_ops_executed'] = run.count_bf(
+            compiler_bf, source.encode('ascii'))
+        if compiler_output != asm:
+            die('error: %s : run.py and the self-hosted compiler disagree' %
+                name)
+        assemble(arch_name, path(name + '.s'), path(name + '.out'))
+        result['run'] = time_stage([path(name + '.out')], path(name + '.in'),
+            path(name + '.out.txt'), repeats)
+        expected_output, result['ops_executed'] = run.count_bf(source,
+            input_bytes)
+        if read_bytes(path(name + '.out.txt')) != expected_output:
+            die('error: %s : compiled program gave the wrong output' % name)
+        workloads[name] = result
+
+    return {'stages' : stages, 'sizes' : sizes, 'workloads' : workloads}
+
+def main():
+    p = argparse.ArgumentParser(
+        description = 'benchmark each stage of the build pipeline')
+    for arch_name in sorted(KNOWN_ARCHS):
+        p.add_argument(arch_name, dest = 'archs', action = 'append_const',
+            const = arch_name)
+    p.add_argument('--repeats', type = int, default = 3,
+        help = 'number of times to run each stage (default %(default)s)')
+    p.add_argument('--work-dir', default = os.path.join(ROOT, 'build', 'bench'),
+        help = 'directory for intermediate files (default %(default)s)')
+    p.add_argument('--output', help = 'json output file (default stdout)')
+    args = p.parse_args()
+
+    results = {
+        'python' : platform.python_version(),
+        'archs' : {},
+    }
+    for arch_name in args.archs or DEFAULT_ARCHS:
+        work_dir = os.path.join(args.work_dir, arch_name.lstrip('-'))
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+        sys.stderr.write('benchmarking %s\n' % arch_name)
+        results['archs'][arch_name] = bench_arch(arch_name, work_dir,
+            args.repeats)
+
+    s = json.dumps(results, indent = 2, sort_keys = True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(s + '\n')
+    else:
+        print(s)
+
+if __name__ == '__main__':
+    main()
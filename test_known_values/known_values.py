@@ -0,0 +1,26 @@
+"""
+a regression test for the known cell values tracked by codegen.py: the
+if block is never run, but shifts the stack, so the values known before
+the while loop must still be found at the same cells after it.
+
+should print AA
+"""
+
+DEF_MACRO('main')(
+    LOCAL('a'),
+    LOCAL('b'),
+    LOCAL('n'),
+    LOCAL('z'),
+    CONSTANT_ADD(INT_CONSTANT(65), 'a'),
+    CONSTANT_ADD(INT_CONSTANT(1), 'n'),
+    WHILE('n')(
+        CLEAR('z'),
+        IF('z')(
+            GROW_STACK(INT_CONSTANT(1)),
+        ),
+        CLEAR('n'),
+    ),
+    COPY('a', 'b'),
+    PUT_CHAR('b'),
+    PUT_CHAR('a'),
+)